@@ -1,14 +1,40 @@
-import logging
+import os
+import sys
+import json
 import time
-from db import init_db, save_flight
-from telegram_utils import send_telegram
-from config import REGIONS
+import signal
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from db import init_db, save_flights, close_db, FlightWriter, filter_new_deals, mark_notified
+from telegram_utils import send_telegram, TelegramDispatcher
+from config import REGIONS, MAX_WORKERS, BACKGROUND_DB_WRITER, NOTIFY_POLICY, ASYNC_TELEGRAM, STREAM_BATCH_SIZE, SCAN_SCHEDULE, DEFAULT_SCAN_INTERVAL, PROMETHEUS_TEXTFILE
 from importlib import import_module
+import db
+from pairing import stay_range_for, DEFAULT_TOP_K
+import http_client
+import tracing
+from file_utils import write_atomic
 
 logging.basicConfig(level=logging.INFO)
 logging.getLogger("seleniumwire").setLevel(logging.WARNING)
 
 performance_metrics = {}
+flight_writer = None
+telegram_dispatcher = None
+incremental_scan = SCAN_SCHEDULE["enabled"]
+stop_event = threading.Event()
+
+DAEMON_STATE_FILE = os.getenv("DAEMON_STATE_FILE", ".daemon_state.json")
+REPLAY_DB_NAME = "replay_flights.db"
+
+def store_flights(flights):
+    """Persist one provider result set, through the background writer when enabled."""
+    if flight_writer:
+        flight_writer.submit(flights)
+    else:
+        save_flights(flights)
 
 def load_provider_class(provider_name):
     module = import_module(f"search_providers.{provider_name}")
@@ -19,100 +45,282 @@ def run_region_search(region_name, region_config):
     logging.info(f"Starting flight search for region: {region_name}")
     start_time = time.time()
     for provider_name in region_config["providers"]:
-        ProviderClass = load_provider_class(provider_name)
-        provider = ProviderClass()
-        logging.info(f"  Using provider: {provider_name}")
-        thresholds = region_config["thresholds"]
-        # Pass notify threshold to AerolineasProvider for efficient validation
-        if provider_name == "aerolineas":
-            results = provider.search_flights(
-                origin=None,
-                destination=region_config["destinations"],
-                start_date=region_config["date_range"][0],
-                end_date=region_config["date_range"][1],
-                notify_threshold=thresholds["notify"]
-            )
-        else:
-            results = provider.search_flights(
-                origin=None,
-                destination=region_config["destinations"],
-                start_date=region_config["date_range"][0],
-                end_date=region_config["date_range"][1]
-            )
-
-        # Buscar la mejor combinación para round trip y one way
-        best_one_way = None
-        best_one_way_price = float('inf')
-        best_round_trip = None
-        best_round_trip_price = float('inf')
-        for flight in results:
-            if flight.get("flight_type") == "ONE_WAY":
-                if flight["totalPrice"] < best_one_way_price:
-                    best_one_way = flight
-                    best_one_way_price = flight["totalPrice"]
-            else:
-                if flight["totalPrice"] < best_round_trip_price:
-                    best_round_trip = flight
-                    best_round_trip_price = flight["totalPrice"]
-
-        if best_one_way:
-            logging.info(
-                "[BEST ONE WAY] Region: %s | Provider: %s | Date: %s | Dest: %s | Price: $%s USD | Link: %s",
-                region_name,
-                provider_name,
-                best_one_way.get('date'),
-                best_one_way.get('destination'),
-                best_one_way.get('totalPrice'),
-                best_one_way.get('webLink')
-            )
-        else:
-            logging.info(
-                "[BEST ONE WAY] Region: %s | Provider: %s | No results found.",
-                region_name,
-                provider_name
-            )
-
-        if best_round_trip:
-            logging.info(
-                "[BEST ROUND TRIP] Region: %s | Provider: %s | Date: %s | Dest: %s | Price: $%s USD | Link: %s",
-                region_name,
-                provider_name,
-                best_round_trip.get('date'),
-                best_round_trip.get('destination'),
-                best_round_trip.get('totalPrice'),
-                best_round_trip.get('webLink')
-            )
-        else:
-            logging.info(
-                "[BEST ROUND TRIP] Region: %s | Provider: %s | No results found.",
-                region_name,
-                provider_name
-            )
-
-        # Normalize and process results
-        for flight in results:
-            # Apply region-specific thresholds
-            if flight.get("flight_type") == "ONE_WAY":
-                if flight["totalPrice"] < thresholds["one_way"]:
-                    save_flight(flight)
-                    send_telegram(flight["message"], parse_mode="HTML")
-            else:
-                if flight["totalPrice"] < thresholds["notify"]:
-                    save_flight(flight)
-                    send_telegram(flight["message"], parse_mode="HTML")
+        # A failing provider must not stop the others (or the daemon)
+        run_search_unit(region_name, region_config, provider_name)
     performance_metrics[f"{region_name}_search_time"] = time.time() - start_time
     logging.info("Flight search for region %s completed.", region_name)
 
-def main():
+def run_provider_search(region_name, region_config, provider_name):
+    """Search, store and notify the results of one provider for one region."""
+    ProviderClass = load_provider_class(provider_name)
+    provider = ProviderClass()
+    logging.info(f"  Using provider: {provider_name}")
+    thresholds = region_config["thresholds"]
+    # Pass notify threshold to AerolineasProvider for efficient validation
+    if provider_name == "aerolineas":
+        results = provider.iter_flights(
+            origin=None,
+            destination=region_config["destinations"],
+            start_date=region_config["date_range"][0],
+            end_date=region_config["date_range"][1],
+            notify_threshold=thresholds["notify"],
+            stay_range=stay_range_for(region_config),
+            top_k=region_config.get("top_k", DEFAULT_TOP_K),
+            incremental=incremental_scan
+        )
+    else:
+        results = provider.iter_flights(
+            origin=None,
+            destination=region_config["destinations"],
+            start_date=region_config["date_range"][0],
+            end_date=region_config["date_range"][1],
+            stay_range=stay_range_for(region_config),
+            incremental=incremental_scan
+        )
+
+    # Results are consumed as they arrive: the best combinations are running
+    # aggregates and qualifying flights are notified/stored every STREAM_BATCH_SIZE
+    best_one_way = None
+    best_one_way_price = float('inf')
+    best_round_trip = None
+    best_round_trip_price = float('inf')
+    to_save = []
+    for flight in results:
+        if stop_event.is_set():
+            logging.info("  Búsqueda de %s interrumpida por el cierre del daemon", provider_name)
+            break
+        if not flight.is_round_trip:
+            if flight.total_price < best_one_way_price:
+                best_one_way = flight
+                best_one_way_price = flight.total_price
+            # Apply region-specific thresholds
+            if flight.total_price < thresholds["one_way"]:
+                to_save.append(flight)
+        else:
+            if flight.total_price < best_round_trip_price:
+                best_round_trip = flight
+                best_round_trip_price = flight.total_price
+            if flight.total_price < thresholds["notify"]:
+                to_save.append(flight)
+        if len(to_save) >= STREAM_BATCH_SIZE:
+            notify_deals(region_config, to_save)
+            store_flights(to_save)
+            to_save = []
+    notify_deals(region_config, to_save)
+    store_flights(to_save)
+
+    if best_one_way:
+        logging.info(
+            "[BEST ONE WAY] Region: %s | Provider: %s | Date: %s | Dest: %s | Price: $%s USD | Link: %s",
+            region_name,
+            provider_name,
+            best_one_way.date,
+            best_one_way.destination,
+            best_one_way.total_price,
+            best_one_way.web_link
+        )
+    else:
+        logging.info(
+            "[BEST ONE WAY] Region: %s | Provider: %s | No results found.",
+            region_name,
+            provider_name
+        )
+
+    if best_round_trip:
+        logging.info(
+            "[BEST ROUND TRIP] Region: %s | Provider: %s | Date: %s | Dest: %s | Price: $%s USD | Link: %s",
+            region_name,
+            provider_name,
+            best_round_trip.date,
+            best_round_trip.destination,
+            best_round_trip.total_price,
+            best_round_trip.web_link
+        )
+    else:
+        logging.info(
+            "[BEST ROUND TRIP] Region: %s | Provider: %s | No results found.",
+            region_name,
+            provider_name
+        )
+
+def notify_deals(region_config, flights):
+    """Send only new deals or meaningful price drops, then record them in the ledger."""
+    if not flights:
+        return
+    policy = region_config.get("notify_policy", NOTIFY_POLICY)
+    new_deals = filter_new_deals(flights, policy["min_drop_usd"], policy["min_drop_pct"])
+    if telegram_dispatcher:
+        # The dispatcher renders and marks them as notified once Telegram accepts each message
+        for flight in new_deals:
+            telegram_dispatcher.submit(flight)
+    else:
+        sent = [flight for flight in new_deals if send_telegram(flight.message, parse_mode="HTML")]
+        mark_notified(sent)
+    if len(new_deals) < len(flights):
+        logging.info("  %d deals already notified at a similar price were skipped", len(flights) - len(new_deals))
+
+def run_search_unit(region_name, region_config, provider_name):
+    """Run one (region, provider) unit in a worker, returning its (start, end) times."""
+    start_time = time.time()
+    try:
+        with tracing.span("provider_search", region=region_name, provider=provider_name):
+            run_provider_search(region_name, region_config, provider_name)
+    except Exception:
+        logging.exception("Provider %s failed for region %s", provider_name, region_name)
+    return start_time, time.time()
+
+def run_parallel_search(regions, max_workers):
+    """Run every (region, provider) pair on a bounded thread pool."""
+    units = [
+        (region_name, region_config, provider_name)
+        for region_name, region_config in regions.items()
+        for provider_name in region_config["providers"]
+    ]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [(unit[0], executor.submit(run_search_unit, *unit)) for unit in units]
+        timings = {}
+        for region_name, future in futures:
+            timings.setdefault(region_name, []).append(future.result())
+    for region_name, spans in timings.items():
+        performance_metrics[f"{region_name}_search_time"] = max(end for _, end in spans) - min(start for start, _ in spans)
+        logging.info("Flight search for region %s completed.", region_name)
+
+def start_services():
+    """Open the database and start the background writer and Telegram dispatcher."""
+    global flight_writer, telegram_dispatcher
     init_db()
-    for region_name, region_config in REGIONS.items():
-        run_region_search(region_name, region_config)
+    if BACKGROUND_DB_WRITER:
+        flight_writer = FlightWriter()
+    if ASYNC_TELEGRAM:
+        telegram_dispatcher = TelegramDispatcher(on_delivered=mark_notified)
+
+def stop_services():
+    """Deliver pending notifications, flush pending writes and close the database."""
+    global flight_writer, telegram_dispatcher
+    if telegram_dispatcher:
+        telegram_dispatcher.close()
+        telegram_dispatcher = None
+    if flight_writer:
+        flight_writer.close()
+        flight_writer = None
+    close_db()
+
+def run_scan(regions, max_workers):
+    if max_workers > 1:
+        run_parallel_search(regions, max_workers)
+    else:
+        for region_name, region_config in regions.items():
+            run_region_search(region_name, region_config)
+
+def log_run_metrics():
     logging.info("--- Performance Metrics ---")
     for key, value in performance_metrics.items():
         logging.info("%s: %.2f minutes", key, value/60)
+    logging.info("--- HTTP Metrics ---")
+    http_client.log_metrics()
+    try:
+        logging.info("Span metrics written to %s and %s", tracing.export(), PROMETHEUS_TEXTFILE)
+    except OSError as e:
+        logging.error("Could not export the span metrics: %s", e)
+
+def main(max_workers=MAX_WORKERS, full_scan=False, record=None, replay=None):
+    """One scan of every region. record/replay: directory to archive the provider traffic to / replay it from."""
+    global incremental_scan
+    if record:
+        http_client.start_recording(record, sys.argv)
+    elif replay:
+        http_client.start_replay(replay)
+        # Replays start from an empty database next to the recording, never the real one
+        db.DB_FILE = os.path.join(replay, REPLAY_DB_NAME)
+        if os.path.exists(db.DB_FILE):
+            os.remove(db.DB_FILE)
+    # The incremental schedule depends on local state, so archived runs request every unit
+    incremental_scan = SCAN_SCHEDULE["enabled"] and not (full_scan or record or replay)
+    start_services()
+    try:
+        run_scan(REGIONS, max_workers)
+    finally:
+        stop_services()
+        http_client.stop_archive()
+    log_run_metrics()
+
+def scan_interval_for(region_config):
+    return region_config.get("scan_interval", DEFAULT_SCAN_INTERVAL)
+
+def load_daemon_state():
+    """{region_name: time its last complete scan finished}, empty if missing or unreadable."""
+    try:
+        with open(DAEMON_STATE_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_daemon_state(state):
+    write_atomic(DAEMON_STATE_FILE, json.dumps(state))
+
+def request_shutdown(signum, frame):
+    logging.info("Señal %d recibida: se termina el escaneo en curso y se cierra el daemon", signum)
+    stop_event.set()
+
+def run_daemon(max_workers=MAX_WORKERS):
+    """
+    Resident loop: scans each region once its scan_interval elapsed, keeping the
+    HTTP sessions, token, caches and database connection warm between scans.
+    SIGTERM/SIGINT stop it after flushing pending writes and notifications.
+    """
+    global incremental_scan
+    incremental_scan = SCAN_SCHEDULE["enabled"]
+    signal.signal(signal.SIGTERM, request_shutdown)
+    signal.signal(signal.SIGINT, request_shutdown)
+    start_services()
+    state = load_daemon_state()
+    logging.info("Daemon iniciado para las regiones: %s", ", ".join(REGIONS))
+    try:
+        while not stop_event.is_set():
+            now = time.time()
+            due = {name: config for name, config in REGIONS.items() if now - state.get(name, 0) >= scan_interval_for(config)}
+            if due:
+                run_scan(due, max_workers)
+                if stop_event.is_set():
+                    # Interrupted scans are redone on the next start
+                    break
+                if flight_writer:
+                    flight_writer.flush()
+                finished = time.time()
+                state.update((name, finished) for name in due)
+                save_daemon_state(state)
+                log_run_metrics()
+            next_scan = min(state.get(name, 0) + scan_interval_for(config) for name, config in REGIONS.items())
+            stop_event.wait(max(1, next_scan - time.time()))
+    finally:
+        stop_services()
+    logging.info("Daemon detenido")
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Busca vuelos baratos y los notifica por Telegram.")
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS,
+                        help="(region, provider) searches run in parallel; 1 runs them sequentially")
+    parser.add_argument("--full-scan", action="store_true",
+                        help="re-fetch every (destination, month), ignoring the incremental scan schedule")
+    parser.add_argument("--daemon", action="store_true",
+                        help="keep running and scan each region every scan_interval seconds")
+    parser.add_argument("--profile-startup", action="store_true",
+                        help="report the import time of app.py and exit")
+    archive = parser.add_mutually_exclusive_group()
+    archive.add_argument("--record", metavar="DIR", help="archive every provider response of this run in DIR")
+    archive.add_argument("--replay", metavar="DIR",
+                         help="re-run offline from the responses archived in DIR (no network, no Chrome)")
+    args = parser.parse_args()
+    if args.daemon and (args.record or args.replay):
+        parser.error("--record/--replay apply to a single run, not to --daemon")
+    if args.profile_startup:
+        # Imported here: it is only needed for this flag (and resource is POSIX-only)
+        import startup_profile
+        startup_profile.report("app")
+    elif args.daemon:
+        run_daemon(max_workers=args.workers)
+    else:
+        main(max_workers=args.workers, full_scan=args.full_scan, record=args.record, replay=args.replay)
 
 def check_flights():
     start_time = time.time()
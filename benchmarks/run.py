@@ -0,0 +1,192 @@
+"""
+Offline benchmark of the hot paths, against synthetic payloads served locally.
+
+    python -m benchmarks.run --destinations 100 --months 12 --output benchmarks/latest.json
+    python -m benchmarks.run --baseline benchmarks/baseline.json
+
+Each stage is timed separately and the results are written as JSON. With
+--baseline, stages slower than the baseline by more than --tolerance are
+reported and the exit code is 1.
+"""
+import os
+import sys
+import json
+import time
+import base64
+import logging
+import argparse
+import platform
+import tempfile
+import subprocess
+from datetime import date, timedelta
+
+from benchmarks.synthetic import StubServer, destination_codes, level_day_prices
+
+log = logging.getLogger(__name__)
+
+STAY_RANGE = (7, 21)
+THRESHOLDS = {"store": 1200, "notify": 900, "one_way": 400}
+STUB_CONCURRENCY = 6
+MAX_SINGLE_SAVES = 5000  # db.save_flight is timed on at most this many flights
+
+def fake_token():
+    """Unsigned JWT that expires in a day; only its "exp" claim is ever read."""
+    payload = base64.urlsafe_b64encode(json.dumps({"exp": time.time() + 86400}).encode()).decode().rstrip("=")
+    return f"bench.{payload}.bench"
+
+def prepare_environment(workdir, stub):
+    """Point the providers at the stub and every file (token, caches, DB) at workdir. Call before importing them."""
+    token_file = os.path.join(workdir, "token.json")
+    with open(token_file, "w") as f:
+        json.dump({"token": fake_token(), "expires_at": time.time() + 86400}, f)
+    os.environ.update({
+        "LEVEL_BASE_URL": stub.base_url,
+        "AEROLINEAS_API_URL": stub.base_url,
+        "AEROLINEAS_TOKEN_CACHE": token_file,
+        "HTTP_CACHE_FILE": os.path.join(workdir, "http_cache.db"),
+    })
+
+def month_range(months):
+    """(start_date, end_date) covering `months` whole months from next month."""
+    today = date.today()
+    first = date(today.year + today.month // 12, today.month % 12 + 1, 1)
+    index = first.year * 12 + first.month - 1 + months  # month right after the last one
+    return first.isoformat(), (date(index // 12, index % 12 + 1, 1) - timedelta(days=1)).isoformat()
+
+def timed(results, name, fn, items=None):
+    """Run fn(), store its timing under results[name] and return its result."""
+    start = time.perf_counter()
+    out = fn()
+    seconds = time.perf_counter() - start
+    count = items(out) if items else None
+    results[name] = {"seconds": round(seconds, 6), "items": count}
+    if count:
+        results[name]["per_item_us"] = round(seconds / count * 1e6, 3)
+        results[name]["items_per_second"] = round(count / seconds, 1) if seconds else None
+    log.info("%-22s %9.3f s  %s", name, seconds, f"{count} items" if count is not None else "")
+    return out
+
+def run_stages(destinations, start_date, end_date, workdir, plots=True):
+    # Imported here: the environment has to point at the stub first
+    import config
+    # The stub stands for both hosts, so they share one entry in the per-host settings:
+    # give it Level's concurrency (the higher one) before http_client sizes its pool
+    config.HOST_CONCURRENCY[config.LEVEL_HOST] = STUB_CONCURRENCY
+    import app
+    import db
+    import stats
+    import telegram_utils
+    from pairing import cheapest_round_trips
+    from search_providers.level import LevelProvider, iter_months
+    from search_providers.aerolineas import AerolineasProvider
+    # Never deliver anything, whatever .env says
+    telegram_utils.TELEGRAM_TOKEN = None
+    db.DB_FILE = os.path.join(workdir, "flights.db")
+    stats.IMG_DIR = os.path.join(workdir, "imgs")
+    db.init_db()
+    results = {}
+
+    level = timed(results, "level_provider", lambda: list(LevelProvider().iter_flights(
+        None, destinations, start_date, end_date, stay_range=STAY_RANGE)), len)
+    aerolineas = timed(results, "aerolineas_provider", lambda: list(AerolineasProvider().iter_flights(
+        None, destinations, start_date, end_date, notify_threshold=THRESHOLDS["notify"], stay_range=STAY_RANGE)), len)
+    flights = level + aerolineas
+
+    months = list(iter_months(start_date, end_date))
+    price_maps = [
+        {day["date"]: day["price"] for day in level_day_prices(dest_code, year, month) if day["price"] is not None}
+        for dest_code in destinations for year, month in months
+    ]
+    timed(results, "pairing", lambda: sum(len(cheapest_round_trips(prices, prices, *STAY_RANGE)) for prices in price_maps),
+          lambda _: len(price_maps))
+
+    # Responses are cached by now (CACHE_TTL follows the stub host), so this measures
+    # filtering, the notification ledger and storage
+    region = {"providers": ["level", "aerolineas"], "date_range": (start_date, end_date), "thresholds": THRESHOLDS,
+              "stay_range": STAY_RANGE, "destinations": destinations}
+    app.incremental_scan = False
+    timed(results, "region_search", lambda: app.run_region_search("benchmark", region), lambda _: len(flights))
+
+    timed(results, "render_messages", lambda: [(flight.message, flight.web_link) for flight in flights], len)
+    single = flights[:MAX_SINGLE_SAVES]
+    timed(results, "db_save_flight", lambda: [db.save_flight(flight) for flight in single], len)
+    timed(results, "db_save_flights", lambda: db.save_flights(flights))
+
+    df = timed(results, "stats_dataframe", lambda: stats.load_history(days=1), len)
+    if plots:
+        timed(results, "stats_plots", lambda: stats.generate_visualizations(df), len)
+    db.close_db()
+    return results
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def compare(results, baseline, tolerance):
+    """Names of the stages slower than in baseline by more than tolerance (0.2 = 20%)."""
+    regressions = []
+    for name, stage in results["stages"].items():
+        previous = baseline.get("stages", {}).get(name)
+        if not previous or not previous["seconds"]:
+            continue
+        ratio = stage["seconds"] / previous["seconds"]
+        log.info("%-22s %6.2fx baseline", name, ratio)
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the scan, storage and report hot paths.")
+    parser.add_argument("--destinations", type=int, default=100)
+    parser.add_argument("--months", type=int, default=12)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-plots", action="store_true", help="skip the stats chart stage")
+    parser.add_argument("--output", default="benchmarks/latest.json")
+    parser.add_argument("--baseline", help="JSON written by a previous run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown before a stage counts as a regression")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    destinations = destination_codes(args.destinations)
+    start_date, end_date = month_range(args.months)
+    stub = StubServer(seed=args.seed).start()
+    with tempfile.TemporaryDirectory(prefix="flybench-") as workdir:
+        prepare_environment(workdir, stub)
+        # The stages log every provider call and undeliverable notification; keep only the timings
+        logging.getLogger().setLevel(logging.ERROR)
+        log.setLevel(logging.INFO)
+        try:
+            stages = run_stages(destinations, start_date, end_date, workdir, plots=not args.no_plots)
+        finally:
+            stub.stop()
+    results = {
+        "meta": {
+            "destinations": args.destinations,
+            "months": args.months,
+            "date_range": [start_date, end_date],
+            "seed": args.seed,
+            "stub_requests": stub.requests,
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "stages": stages,
+    }
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    log.info("Results written to %s", args.output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            log.warning("Slower than baseline: %s", ", ".join(regressions))
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""
+Synthetic provider payloads and a local stub HTTP server serving them, so the
+benchmarks never touch the network. Payloads are deterministic for a given seed.
+"""
+import json
+import random
+import threading
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+ARS_PER_USD = 1285
+FLEX_WINDOW = (3, 3)
+SOLD_OUT_RATE = 0.05
+NO_PRICE_RATE = 0.1
+VALID_RATE = 0.8
+
+# Destinations the stats report lays out explicitly come first
+KNOWN_DESTINATIONS = ["MAD", "BCN", "VLC", "SVQ"]
+
+def destination_codes(count):
+    """count distinct three-letter codes: KNOWN_DESTINATIONS, then AAA, AAB, ..."""
+    letters = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+    synthetic = (letters[i // 676 % 26] + letters[i // 26 % 26] + letters[i % 26] for i in range(26 ** 3))
+    codes = KNOWN_DESTINATIONS + [code for code in synthetic if code not in KNOWN_DESTINATIONS]
+    return codes[:count]
+
+def level_day_prices(dest_code, year, month, seed=0):
+    """dayPrices of a Level calendar month: EUR prices, some days without price."""
+    rnd = random.Random(f"{seed}/level/{dest_code}/{year}-{month}")
+    day = date(year, month, 1)
+    days = []
+    while day.month == month:
+        price = None if rnd.random() < NO_PRICE_RATE else round(rnd.uniform(90, 900), 2)
+        days.append({"date": day.isoformat(), "price": price})
+        day += timedelta(days=1)
+    return days
+
+def level_calendar(dest_code, year, month, seed=0):
+    return {"data": {"dayPrices": level_day_prices(dest_code, year, month, seed)}}
+
+def _offers(leg_key, anchor, seed):
+    rnd = random.Random(f"{seed}/aerolineas/{leg_key}")
+    before, after = FLEX_WINDOW
+    return [
+        {
+            "departure": (anchor + timedelta(days=offset)).isoformat(),
+            "soldOut": rnd.random() < SOLD_OUT_RATE,
+            "offerDetails": {"fare": {"total": rnd.randint(250, 700) * ARS_PER_USD}}
+        }
+        for offset in range(-before, after + 1)
+    ]
+
+def aerolineas_calendar_offers(dest_code, ida_anchor, vuelta_anchor, seed=0):
+    """flexDates response: "0" holds the outbound window, "1" the return window."""
+    return {"calendarOffers": {
+        "0": _offers(f"BUE-{dest_code}-{ida_anchor}", ida_anchor, seed),
+        "1": _offers(f"{dest_code}-BUE-{vuelta_anchor}", vuelta_anchor, seed),
+    }}
+
+def aerolineas_validation(legs, seed=0):
+    """flexDates=false response: bookable round trips carry offers."""
+    rnd = random.Random(f"{seed}/validation/{'/'.join(legs)}")
+    return {"offers": [{"id": 1}]} if rnd.random() < VALID_RATE else {"offers": []}
+
+def _leg_date(leg):
+    ymd = leg.rsplit("-", 1)[1]
+    return date(int(ymd[:4]), int(ymd[4:6]), int(ymd[6:]))
+
+class StubServer:
+    """Serves the Level calendar and Aerolíneas offers endpoints on 127.0.0.1."""
+    def __init__(self, seed=0):
+        self.seed = seed
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name="stub-server", daemon=True)
+
+    @property
+    def base_url(self):
+        return "http://127.0.0.1:%d" % self._server.server_address[1]
+
+    def payload(self, path, query):
+        """Response body for a request, or None if the endpoint is unknown."""
+        if path.startswith("/nwe/flights/api/calendar"):
+            return level_calendar(query["destination"][0], int(query["year"][0]), int(query["month"][0]), self.seed)
+        if path.startswith("/v1/flights/offers"):
+            legs = query["leg"]
+            if query.get("flexDates") == ["false"]:
+                return aerolineas_validation(legs, self.seed)
+            dest_code = legs[0].split("-")[1]
+            return aerolineas_calendar_offers(dest_code, _leg_date(legs[0]), _leg_date(legs[1]), self.seed)
+        return None
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body go out in separate writes; avoid the delayed-ACK stall on keep-alive
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                parts = urlsplit(self.path)
+                body = stub.payload(parts.path, parse_qs(parts.query))
+                with stub._lock:
+                    stub.requests += 1
+                data = json.dumps(body).encode() if body is not None else b"{}"
+                self.send_response(200 if body is not None else 404)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
@@ -1,14 +1,84 @@
+import os
+from urllib.parse import urlsplit
+
+# Provider API base URLs. Override them through the environment to point the
+# providers at a local stub server (see benchmarks/); the per-host settings
+# below follow the configured hosts
+LEVEL_BASE_URL = os.getenv("LEVEL_BASE_URL", "https://www.flylevel.com")
+AEROLINEAS_API_URL = os.getenv("AEROLINEAS_API_URL", "https://api.aerolineas.com.ar")
+LEVEL_HOST = urlsplit(LEVEL_BASE_URL).hostname
+AEROLINEAS_HOST = urlsplit(AEROLINEAS_API_URL).hostname
+
 REGIONS = {
     "spain": {
         "providers": ["aerolineas", "level"],
         "date_range": ("2026-01-01", "2026-06-30"),
         "thresholds": {"store": 1200, "notify": 900, "one_way": 400},
+        "stay_range": (14, 14),  # (min, max) days between outbound and return
+        "scan_interval": 2 * 60 * 60,  # seconds between scans in daemon mode
+        "top_k": 10,  # cheapest Aerolíneas combinations kept per destination/month
         "destinations": ["MAD", "BCN"]  # Add more as needed
     },
     "australia": {
         "providers": ["level"],
         "date_range": ("2025-10-01", "2026-01-31"),
         "thresholds": {"store": 1800, "notify": 1500, "one_way": 800},
+        "stay_range": (14, 14),
+        "scan_interval": 6 * 60 * 60,
         "destinations": ["SYD", "MEL"]  # Add more as needed
     }
 }
+
+# Maximum number of simultaneous requests per host
+HOST_CONCURRENCY = {
+    LEVEL_HOST: 6,
+    AEROLINEAS_HOST: 2
+}
+
+# (region, provider) searches run in parallel by app.main; 1 = sequential
+MAX_WORKERS = 4
+
+# Persist flights from a background thread instead of the search workers
+BACKGROUND_DB_WRITER = True
+
+# Re-announce a deal only when its price drops at least this much since the last
+# notification (either criterion is enough). Regions may override it with "notify_policy".
+NOTIFY_POLICY = {"min_drop_usd": 25, "min_drop_pct": 5}
+
+# Send Telegram notifications from a background queue, packing several deals per message
+ASYNC_TELEGRAM = True
+
+# Seconds a cached provider response stays fresh (per host), and cache size cap
+CACHE_TTL = {
+    LEVEL_HOST: 60 * 60,
+    AEROLINEAS_HOST: 30 * 60
+}
+CACHE_MAX_BYTES = 200 * 1024 * 1024
+
+# Seconds a real-ticket validation result is reused
+VALIDATION_CACHE_TTL = {"valid": 2 * 60 * 60, "invalid": 30 * 60}
+
+# Qualifying flights are notified and stored in batches of this size while a scan streams
+STREAM_BATCH_SIZE = 50
+
+# Incremental scans: each (provider, destination, month) is re-fetched only once
+# its refresh interval elapsed. Volatile months and near travel dates refresh sooner.
+SCAN_SCHEDULE = {
+    "enabled": True,
+    "min_interval": 60 * 60,       # seconds, for the most volatile and closest months
+    "max_interval": 24 * 60 * 60,  # seconds, for months whose prices never change
+    "horizon_days": 120,           # months starting further away get no proximity boost
+    "volatility_alpha": 0.3,       # weight of the latest scan in the volatility average
+    "max_units_per_run": None,     # per provider and run, most urgent first; None = every due unit
+}
+
+# Seconds between scans of a region in daemon mode (app.py --daemon) when it sets no "scan_interval"
+DEFAULT_SCAN_INTERVAL = 3 * 60 * 60
+
+# Per-run span metrics (tracing.py): one JSON file per run in METRICS_DIR, plus a
+# Prometheus textfile (node_exporter textfile collector) overwritten on every run
+METRICS_DIR = os.getenv("METRICS_DIR", "metrics")
+PROMETHEUS_TEXTFILE = os.getenv("PROMETHEUS_TEXTFILE", os.path.join(METRICS_DIR, "flight_bot.prom"))
+
+# Seconds `python app.py|stats.py --profile-startup` may spend importing before it fails
+STARTUP_BUDGET = {"app": 0.5, "stats": 1.0}
@@ -1,25 +1,150 @@
 import sqlite3
+import queue
+import logging
+import threading
+import tracing
 from contextlib import contextmanager
 
 DB_FILE = "flights.db"
 
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA busy_timeout=5000",
+)
+
+# Natural key of a deal; one-way flights have a NULL return_date
+DEAL_KEY = "date, IFNULL(return_date, ''), destination, airline, flight_type"
+
+UPSERT_FLIGHT = f"""
+    INSERT INTO flights (date, price, return_date, return_price, totalPrice, destination, webLink, airline, flight_type,
+                         first_seen, last_seen, min_price)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP, ?)
+    ON CONFLICT ({DEAL_KEY}) DO UPDATE SET
+        price = excluded.price,
+        return_price = excluded.return_price,
+        totalPrice = excluded.totalPrice,
+        webLink = excluded.webLink,
+        last_seen = excluded.last_seen,
+        min_price = MIN(IFNULL(flights.min_price, excluded.totalPrice), excluded.totalPrice)
+"""
+
+_conn = None
+_conn_lock = threading.Lock()
+
+def get_db():
+    """Return the long-lived, WAL-mode connection shared by the whole process."""
+    global _conn
+    if _conn is None:
+        _conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+        for pragma in PRAGMAS:
+            _conn.execute(pragma)
+    return _conn
+
+def close_db():
+    global _conn
+    with _conn_lock:
+        if _conn is not None:
+            _conn.close()
+            _conn = None
+
 def init_db():
-    with sqlite3.connect(DB_FILE) as conn:
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS flights (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                date TEXT,
-                price INTEGER,
-                return_date TEXT,
-                return_price INTEGER,
-                totalPrice INTEGER,
-                destination TEXT,
-                webLink TEXT,
-                airline TEXT,
-                flight_type TEXT,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
+    with _conn_lock:
+        conn = get_db()
+        with conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS flights (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    date TEXT,
+                    price INTEGER,
+                    return_date TEXT,
+                    return_price INTEGER,
+                    totalPrice INTEGER,
+                    destination TEXT,
+                    webLink TEXT,
+                    airline TEXT,
+                    flight_type TEXT,
+                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            migrate(conn)
+
+def _migrate_deal_key(conn):
+    """Track first/last sighting and min price, collapse duplicate deals and index the table."""
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(flights)")}
+    for column, column_type in (("first_seen", "DATETIME"), ("last_seen", "DATETIME"), ("min_price", "REAL")):
+        if column not in columns:
+            conn.execute(f"ALTER TABLE flights ADD COLUMN {column} {column_type}")
+    # Keep the latest row of each deal, carrying over when it was first seen and its cheapest price.
+    # One GROUP BY pass into a table keyed by the kept id, instead of a correlated scan per row
+    conn.execute("CREATE TEMP TABLE deal_history (keep_id INTEGER PRIMARY KEY, first_seen DATETIME, min_price REAL)")
+    conn.execute(f"""
+        INSERT INTO deal_history (keep_id, first_seen, min_price)
+        SELECT MAX(id), MIN(created_at), MIN(totalPrice) FROM flights GROUP BY {DEAL_KEY}
+    """)
+    conn.execute("""
+        UPDATE flights SET
+            (first_seen, min_price) = (SELECT first_seen, min_price FROM deal_history WHERE keep_id = flights.id),
+            last_seen = created_at
+        WHERE id IN (SELECT keep_id FROM deal_history)
+    """)
+    conn.execute("DELETE FROM flights WHERE id NOT IN (SELECT keep_id FROM deal_history)")
+    conn.execute("DROP TABLE deal_history")
+    conn.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS idx_flights_deal ON flights ({DEAL_KEY})")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_flights_destination_date ON flights (destination, date, totalPrice)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_flights_created_at ON flights (created_at)")
+
+def _create_notifications(conn):
+    """Ledger of the last price announced for each deal."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS notifications (
+            date TEXT,
+            return_date TEXT,
+            destination TEXT,
+            airline TEXT,
+            flight_type TEXT,
+            last_price REAL,
+            notified_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    conn.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS idx_notifications_deal ON notifications ({DEAL_KEY})")
+
+def _index_last_seen(conn):
+    """History queries filter on when a deal was last observed."""
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_flights_last_seen ON flights (last_seen)")
+
+def _create_scan_units(conn):
+    """Change history of each (provider, destination, month) scanned, used by scan_schedule."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS scan_units (
+            provider TEXT,
+            destination TEXT,
+            month TEXT,
+            last_scan REAL,
+            fingerprint TEXT,
+            volatility REAL DEFAULT 0,
+            scans INTEGER DEFAULT 0,
+            changes INTEGER DEFAULT 0,
+            PRIMARY KEY (provider, destination, month)
+        )
+    """)
+
+# Applied in order; PRAGMA user_version records how many already ran
+MIGRATIONS = [
+    _migrate_deal_key,
+    _create_notifications,
+    _index_last_seen,
+    _create_scan_units,
+]
+
+def migrate(conn):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        logging.info("Aplicando migración %d de la base de datos: %s", number, migration.__name__)
+        migration(conn)
+        conn.execute(f"PRAGMA user_version = {number}")
 
 @contextmanager
 def get_conn():
@@ -29,23 +154,144 @@ def get_conn():
     finally:
         conn.close()
 
+def _flight_row(flight):
+    return (
+        flight.date,
+        flight.price,
+        flight.return_date,
+        flight.return_price,
+        flight.total_price,
+        flight.destination,
+        flight.web_link,
+        flight.airline,
+        flight.flight_type,
+        flight.total_price
+    )
+
+@tracing.span("db_write", op="save_flights")
+def save_flights(flights):
+    """
+    Upsert a batch of flights in a single transaction. A deal already stored
+    gets its prices and last_seen refreshed instead of a new row.
+    Returns the number of rows written.
+    """
+    rows = [_flight_row(flight) for flight in flights]
+    if not rows:
+        return 0
+    with _conn_lock:
+        conn = get_db()
+        with conn:
+            conn.executemany(UPSERT_FLIGHT, rows)
+    return len(rows)
+
 def save_flight(flight):
-    with get_conn() as conn:
-        conn.execute(
-            """
-            INSERT INTO flights (date, price, return_date, return_price, totalPrice, destination, webLink, airline, flight_type)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """,
-            (
-                flight.get("date"),
-                flight.get("price"),
-                flight.get("return_date"),
-                flight.get("return_price"),
-                flight.get("totalPrice"),
-                flight.get("destination"),
-                flight.get("webLink"),
-                flight.get("airline"),
-                flight.get("flight_type", "ROUND_TRIP")
-            )
-        )
-        conn.commit()
+    """Upsert a single flights.Flight."""
+    save_flights([flight])
+
+def _deal_key(flight):
+    return (flight.date, flight.return_date or "", flight.destination, flight.airline, flight.flight_type)
+
+@tracing.span("db_read", op="filter_new_deals")
+def filter_new_deals(flights, min_drop_usd=0, min_drop_pct=0):
+    """
+    Return the flights worth announcing: deals never notified before, or whose
+    price dropped by at least min_drop_usd or min_drop_pct since the last notification.
+    """
+    flights = list(flights)
+    if not flights:
+        return []
+    new_deals = []
+    with _conn_lock:
+        conn = get_db()
+        for flight in flights:
+            row = conn.execute(
+                f"SELECT last_price FROM notifications WHERE ({DEAL_KEY}) = (?, ?, ?, ?, ?)",
+                _deal_key(flight)
+            ).fetchone()
+            if row is None or row[0] is None:
+                new_deals.append(flight)
+                continue
+            drop = row[0] - flight.total_price
+            if drop > 0 and (drop >= min_drop_usd or drop * 100 >= row[0] * min_drop_pct):
+                new_deals.append(flight)
+    return new_deals
+
+@tracing.span("db_write", op="mark_notified")
+def mark_notified(flights):
+    """Record the price at which each flight was announced."""
+    rows = [(flight.date, flight.return_date, flight.destination, flight.airline,
+             flight.flight_type, flight.total_price) for flight in flights]
+    if not rows:
+        return
+    with _conn_lock:
+        conn = get_db()
+        with conn:
+            conn.executemany(f"""
+                INSERT INTO notifications (date, return_date, destination, airline, flight_type, last_price)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT ({DEAL_KEY}) DO UPDATE SET
+                    last_price = excluded.last_price,
+                    notified_at = CURRENT_TIMESTAMP
+            """, rows)
+
+def load_scan_units(provider):
+    """{(destination, month): (last_scan, fingerprint, volatility)} for one provider."""
+    with _conn_lock:
+        rows = get_db().execute(
+            "SELECT destination, month, last_scan, fingerprint, volatility FROM scan_units WHERE provider = ?",
+            (provider,)
+        ).fetchall()
+    return {(destination, month): (last_scan, fingerprint, volatility) for destination, month, last_scan, fingerprint, volatility in rows}
+
+@tracing.span("db_write", op="save_scan_unit")
+def save_scan_unit(provider, destination, month, last_scan, fingerprint, volatility, changed):
+    """Record one scan of a unit and whether its prices changed since the previous one."""
+    with _conn_lock:
+        conn = get_db()
+        with conn:
+            conn.execute("""
+                INSERT INTO scan_units (provider, destination, month, last_scan, fingerprint, volatility, scans, changes)
+                VALUES (?, ?, ?, ?, ?, ?, 1, ?)
+                ON CONFLICT (provider, destination, month) DO UPDATE SET
+                    last_scan = excluded.last_scan,
+                    fingerprint = excluded.fingerprint,
+                    volatility = excluded.volatility,
+                    scans = scan_units.scans + 1,
+                    changes = scan_units.changes + excluded.changes
+            """, (provider, destination, month, last_scan, fingerprint, volatility, int(changed)))
+
+class FlightWriter:
+    """Background thread that persists submitted batches so scanning never waits on disk."""
+    _STOP = object()
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="flight-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, flights):
+        flights = list(flights)
+        if flights:
+            self._queue.put(flights)
+
+    def _run(self):
+        while True:
+            batch = self._queue.get()
+            if batch is self._STOP:
+                return
+            try:
+                save_flights(batch)
+            except Exception:
+                # Keep the thread alive: later batches still have to be written and flush() would block forever
+                logging.exception("Error guardando %d vuelos", len(batch))
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        """Block until every batch submitted so far is written."""
+        self._queue.join()
+
+    def close(self):
+        """Flush pending batches and stop the writer thread."""
+        self._queue.put(self._STOP)
+        self._thread.join()
@@ -0,0 +1,13 @@
+import os
+
+def write_atomic(path, text):
+    """
+    Write text to path through a temporary file and os.replace(), so readers
+    (other processes, the next start after a crash) see either the previous or
+    the new content, never half of it.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
@@ -0,0 +1,41 @@
+"""
+Flight record shared by the providers, db.py and telegram_utils.py.
+Links and HTML messages are rendered on demand by the renderer each provider
+registers for its airline, so fares that are never stored or notified never
+pay for the string formatting.
+"""
+from dataclasses import dataclass
+
+ONE_WAY = "ONE_WAY"
+ROUND_TRIP = "ROUND_TRIP"
+
+_renderers = {}
+
+def register_renderer(airline, web_link, message):
+    """Register the functions that build the link and the HTML message of an airline's flights."""
+    _renderers[airline] = (web_link, message)
+
+@dataclass(slots=True)
+class Flight:
+    airline: str
+    destination: str
+    date: str
+    price: float
+    total_price: float
+    flight_type: str = ONE_WAY
+    return_date: str = None
+    return_price: float = None
+    stay: int = None
+    validated: bool = False
+
+    @property
+    def is_round_trip(self):
+        return self.flight_type == ROUND_TRIP
+
+    @property
+    def web_link(self):
+        return _renderers[self.airline][0](self)
+
+    @property
+    def message(self):
+        return _renderers[self.airline][1](self)
@@ -1,27 +1,155 @@
 import os
-from seleniumwire import webdriver
-from selenium.webdriver.chrome.options import Options
+import re
+import json
+import time
+import base64
+import threading
 import logging
+import http_client
+import tracing
+from file_utils import write_atomic
+
+try:
+    import fcntl
+except ImportError:  # Windows: fall back to the in-process lock only
+    fcntl = None
 
 URL = "https://www.aerolineas.com.ar/"
+API_HOST = "api.aerolineas.com.ar"
+TOKEN_TIMEOUT = int(os.getenv("AEROLINEAS_TOKEN_TIMEOUT", "45"))  # seconds
+POLL_INTERVAL = 0.25
+BLOCKED_URL_PATTERNS = [
+    "*.png", "*.jpg", "*.jpeg", "*.gif", "*.webp", "*.svg", "*.ico",
+    "*.woff", "*.woff2", "*.ttf", "*.otf", "*.mp4", "*.webm",
+]
+TOKEN_CACHE_FILE = os.getenv("AEROLINEAS_TOKEN_CACHE", ".aerolineas_token.json")
+DEFAULT_TOKEN_TTL = 30 * 60  # seconds, used when the token carries no "exp"
+EXPIRY_MARGIN = 60  # refresh a bit before the real expiry
+REPLAY_TOKEN = "replay"
+
+_token_lock = threading.Lock()
+# Token of this process kept in memory as {"token", "expires_at"}, so a long-running
+# process (app.py --daemon) does not read the cache file on every scan
+_memory_token = {}
+
+def _find_bearer(requests_):
+    for request in requests_:
+        if API_HOST in request.url:
+            auth_header = request.headers.get('Authorization')
+            if auth_header and auth_header.startswith("Bearer "):
+                return auth_header.split("Bearer ")[1], request.url
+    return None, None
 
-def get_token_with_selenium_wire():
+@tracing.span("token_browser")
+def get_token_with_selenium_wire(lean=True, timeout=TOKEN_TIMEOUT):
+    """
+    Open aerolineas.com.ar in headless Chrome and return the first bearer token
+    sent to the API. In lean mode only api.aerolineas.com.ar is intercepted,
+    images/fonts/media are blocked, the page is not waited for and the search
+    stops at the first Authorization header or after `timeout` seconds.
+    """
+    # Imported here: selenium/seleniumwire take longer to import than the rest of the bot
+    from seleniumwire import webdriver
+    from selenium.webdriver.chrome.options import Options
     logging.info("Iniciando Selenium Wire para obtener el token de las requests de red...")
     options = Options()
     options.add_argument("--headless")
     chrome_path = os.getenv("CHROME_PATH")
     if chrome_path:
         options.binary_location = chrome_path
-    driver = webdriver.Chrome(options=options)
-    driver.get(URL)
+    seleniumwire_options = {}
+    if lean:
+        options.add_argument("--disable-gpu")
+        options.add_argument("--disable-extensions")
+        options.add_argument("--blink-settings=imagesEnabled=false")
+        # Do not block on the full page load, we only need its first API calls
+        options.page_load_strategy = "none"
+        seleniumwire_options = {"request_storage": "memory", "request_storage_max_size": 50}
+    driver = webdriver.Chrome(options=options, seleniumwire_options=seleniumwire_options)
+    token, token_url = None, None
+    try:
+        if not lean:
+            driver.set_page_load_timeout(timeout)
+            driver.get(URL)
+            token, token_url = _find_bearer(request for request in driver.requests if request.response)
+        else:
+            driver.scopes = [r".*" + re.escape(API_HOST) + r".*"]
+            driver.execute_cdp_cmd("Network.enable", {})
+            driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": BLOCKED_URL_PATTERNS})
+            driver.get(URL)
+            deadline = time.monotonic() + timeout
+            while token is None and time.monotonic() < deadline:
+                token, token_url = _find_bearer(driver.requests)
+                if token is None:
+                    time.sleep(POLL_INTERVAL)
+    except Exception as e:
+        logging.error("Error obteniendo el token con Selenium Wire: %s", e)
+    finally:
+        driver.quit()
+    if token:
+        logging.info(f"Token encontrado en request a {token_url}")
+    else:
+        logging.error("No se encontró el token de Aerolíneas en %s segundos", timeout)
+    return token
 
-    token = None
-    for request in driver.requests:
-        if request.response and "api.aerolineas.com.ar" in request.url:
-            auth_header = request.headers.get('Authorization')
-            if auth_header and auth_header.startswith("Bearer "):
-                token = auth_header.split("Bearer ")[1]
-                logging.info(f"Token encontrado en request a {request.url}")
-                break
-    driver.quit()
-    return token
\ No newline at end of file
+def decode_jwt_expiry(token):
+    """Return the "exp" claim of a JWT as a unix timestamp, or None if it is not a JWT."""
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        exp = json.loads(base64.urlsafe_b64decode(payload)).get("exp")
+        return float(exp) if exp else None
+    except (IndexError, ValueError, AttributeError):
+        return None
+
+def _is_fresh(cached):
+    return bool(cached.get("token")) and cached.get("expires_at", 0) - EXPIRY_MARGIN > time.time()
+
+def _read_cached_token():
+    try:
+        with open(TOKEN_CACHE_FILE) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if _is_fresh(cached):
+        _memory_token.update(token=cached["token"], expires_at=cached["expires_at"])
+        return cached["token"]
+    return None
+
+def _write_cached_token(token):
+    expires_at = decode_jwt_expiry(token) or time.time() + DEFAULT_TOKEN_TTL
+    _memory_token.update(token=token, expires_at=expires_at)
+    write_atomic(TOKEN_CACHE_FILE, json.dumps({"token": token, "expires_at": expires_at, "fetched_at": time.time()}))
+
+@tracing.span("token_acquire")
+def get_token(invalid_token=None):
+    """
+    Return a bearer token, reusing the on-disk cache shared by app.py and stats.py.
+    Pass the token that just got a 401 as invalid_token to force a refresh; if
+    another process already replaced it, the newer cached token is reused.
+    """
+    if http_client.is_replaying():
+        # Recorded responses do not check it; never start Chrome on replay
+        return REPLAY_TOKEN
+    with _token_lock:
+        if _is_fresh(_memory_token) and _memory_token["token"] != invalid_token:
+            return _memory_token["token"]
+        cached = _read_cached_token()
+        if cached and cached != invalid_token:
+            return cached
+        lock_file = open(f"{TOKEN_CACHE_FILE}.lock", "w")
+        try:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            # Another process may have refreshed it while we were waiting
+            cached = _read_cached_token()
+            if cached and cached != invalid_token:
+                return cached
+            token = get_token_with_selenium_wire()
+            if token:
+                _write_cached_token(token)
+            return token
+        finally:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
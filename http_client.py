@@ -0,0 +1,208 @@
+"""
+Shared HTTP client for every outbound call: pooled keep-alive sessions,
+per-host concurrency limits, retries with jittered exponential backoff,
+optional on-disk response caching, per-host latency/status metrics and
+record/replay of the traffic (traffic_archive).
+"""
+import time
+import random
+import logging
+import threading
+from collections import Counter
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from config import HOST_CONCURRENCY
+import response_cache
+import traffic_archive
+import tracing
+
+DEFAULT_TIMEOUT = (5, 15)  # (connect, read) seconds
+DEFAULT_RETRIES = 3
+BACKOFF_BASE = 0.5  # seconds
+BACKOFF_MAX = 8
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+DEFAULT_HEADERS = {"User-Agent": "Mozilla/5.0"}
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)  # seconds, upper bounds
+
+_session = requests.Session()
+_session.headers.update(DEFAULT_HEADERS)
+_adapter = HTTPAdapter(pool_connections=8, pool_maxsize=max([4] + list(HOST_CONCURRENCY.values())))
+_session.mount("https://", _adapter)
+_session.mount("http://", _adapter)
+
+_host_slots = {}
+_metrics = {}
+_lock = threading.Lock()
+_recorder = None
+_replayer = None
+
+def _slots_for(host):
+    with _lock:
+        if host not in _host_slots:
+            _host_slots[host] = threading.BoundedSemaphore(HOST_CONCURRENCY.get(host, 4))
+        return _host_slots[host]
+
+def _host_metrics(host):
+    # Caller holds _lock
+    return _metrics.setdefault(host, {
+        "count": 0,
+        "cache_hits": 0,
+        "total_seconds": 0.0,
+        "statuses": Counter(),
+        "latency_buckets": [0] * (len(LATENCY_BUCKETS) + 1),
+    })
+
+def _record(host, status, elapsed, method="GET", size=None):
+    tracing.observe("http_request", elapsed, host=host, method=method, status=status)
+    if size is not None:
+        tracing.add("http_response_bytes", size, host=host)
+    with _lock:
+        metrics = _host_metrics(host)
+        metrics["count"] += 1
+        metrics["total_seconds"] += elapsed
+        metrics["statuses"][status] += 1
+        index = next((i for i, bound in enumerate(LATENCY_BUCKETS) if elapsed <= bound), len(LATENCY_BUCKETS))
+        metrics["latency_buckets"][index] += 1
+
+def _record_cache_hit(host):
+    tracing.add("http_cache_hits", host=host)
+    with _lock:
+        _host_metrics(host)["cache_hits"] += 1
+
+def _backoff(attempt, retry_after=None):
+    if retry_after is not None:
+        return retry_after
+    # Full jitter: spreads retries of concurrent workers apart
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt)))
+
+def _retry_after(res):
+    try:
+        return float(res.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+def request(method, url, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES, **kwargs):
+    """
+    Send a request through the shared session. Connection errors and
+    RETRY_STATUSES are retried `retries` times; the final response is returned
+    whatever its status, so callers decide how to treat 4xx. Raises
+    requests.RequestException when every attempt failed without a response.
+    """
+    host = urlsplit(url).hostname or ""
+    if _replayer:
+        start = time.monotonic()
+        try:
+            res = _replayer.respond(method, url)
+        except requests.RequestException as e:
+            _record(host, type(e).__name__, time.monotonic() - start, method)
+            logging.error("%s %s failed: %s", method, url, e)
+            raise
+        _record(host, res.status_code, time.monotonic() - start, method, len(res.content))
+        return res
+    for attempt in range(retries + 1):
+        start = time.monotonic()
+        try:
+            with _slots_for(host):
+                res = _session.request(method, url, timeout=timeout, **kwargs)
+        except requests.RequestException as e:
+            _record(host, type(e).__name__, time.monotonic() - start, method)
+            if attempt == retries:
+                logging.error("%s %s failed after %d attempts: %s", method, url, attempt + 1, e)
+                raise
+            logging.warning("%s %s failed (attempt %d/%d): %s", method, url, attempt + 1, retries + 1, e)
+            time.sleep(_backoff(attempt))
+            continue
+        _record(host, res.status_code, time.monotonic() - start, method, len(res.content))
+        if res.status_code in RETRY_STATUSES and attempt < retries:
+            logging.warning("%s %s returned %d (attempt %d/%d)", method, url, res.status_code, attempt + 1, retries + 1)
+            time.sleep(_backoff(attempt, _retry_after(res)))
+            continue
+        if _recorder:
+            _recorder.record(method, url, res)
+        return res
+
+def _cached_response(url, body):
+    res = requests.Response()
+    res.status_code = 200
+    res._content = body
+    res.url = url
+    res.headers["X-Cache"] = "HIT"
+    return res
+
+def get(url, cache=False, **kwargs):
+    """
+    GET through the shared session. With cache=True a response younger than the
+    host TTL in config.CACHE_TTL is served from response_cache, and fresh 200
+    responses are stored there.
+    """
+    if cache:
+        body = response_cache.get(url)
+        if body is not None:
+            _record_cache_hit(urlsplit(url).hostname or "")
+            return _cached_response(url, body)
+    res = request("GET", url, **kwargs)
+    if cache and res.status_code == 200:
+        response_cache.put(url, res.content)
+    return res
+
+def start_recording(directory, argv=None):
+    """
+    Archive every response from now on. Cached responses are bypassed so every
+    call is captured; memo:// entries (flex window, validations) are still used.
+    """
+    global _recorder
+    response_cache.disable(memo=False)
+    _recorder = traffic_archive.Recorder(directory, argv)
+
+def start_replay(directory):
+    """Answer every request from a recording instead of the network."""
+    global _replayer
+    response_cache.disable()
+    _replayer = traffic_archive.Replayer(directory)
+    return _replayer
+
+def is_recording():
+    return _recorder is not None
+
+def is_replaying():
+    return _replayer is not None
+
+def annotate_archive(key, value):
+    """Store a run setting in the recording in progress, if any."""
+    if _recorder:
+        _recorder.annotate(key, value)
+
+def archived_setting(key):
+    """A setting stored with annotate_archive() in the recording being replayed, or None."""
+    return _replayer.meta.get(key) if _replayer else None
+
+def stop_archive():
+    """Close the recording or replay in progress, if any."""
+    global _recorder, _replayer
+    for archive in (_recorder, _replayer):
+        if archive:
+            archive.close()
+    _recorder = _replayer = None
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
+
+def get_metrics():
+    """Snapshot of the per-host request metrics collected so far."""
+    with _lock:
+        return {
+            host: {
+                "count": m["count"],
+                "cache_hits": m["cache_hits"],
+                "avg_seconds": m["total_seconds"] / m["count"] if m["count"] else 0,
+                "statuses": dict(m["statuses"]),
+                "latency_buckets": dict(zip([f"<={b}s" for b in LATENCY_BUCKETS] + ["+Inf"], m["latency_buckets"])),
+            }
+            for host, m in _metrics.items()
+        }
+
+def log_metrics():
+    for host, m in get_metrics().items():
+        logging.info("%s: %d requests, %d cache hits, avg %.2fs, statuses %s",
+                     host, m["count"], m["cache_hits"], m["avg_seconds"], m["statuses"])
@@ -0,0 +1,73 @@
+"""
+Round-trip pairing shared by the providers and stats.py.
+Dates are parsed once into ordinals, so finding the returns of an outbound
+date costs one dict lookup per allowed stay length instead of a scan.
+"""
+import heapq
+import tracing
+from datetime import date
+
+DEFAULT_STAY_RANGE = (14, 14)  # (min, max) days between outbound and return
+DEFAULT_TOP_K = 10
+
+def stay_range_for(region_config):
+    """(min_stay, max_stay) configured for a region in config.REGIONS."""
+    min_stay, max_stay = region_config.get("stay_range", DEFAULT_STAY_RANGE)
+    if min_stay < 1 or max_stay < min_stay:
+        raise ValueError(f"Invalid stay_range {(min_stay, max_stay)}")
+    return min_stay, max_stay
+
+def to_ordinal(iso_date):
+    return date.fromisoformat(iso_date).toordinal()
+
+class DateIndex:
+    """Index of available ISO dates (e.g. days with a price) by ordinal."""
+    def __init__(self, dates):
+        self.ordinals = {d: to_ordinal(d) for d in dates}
+        self.by_ordinal = {o: d for d, o in self.ordinals.items()}
+
+    def sorted_dates(self):
+        return sorted(self.ordinals, key=self.ordinals.get)
+
+    def returns_for(self, outbound_date, min_stay, max_stay, last_date=None):
+        """Yield (return_date, stay) for every indexed date min_stay..max_stay days after outbound_date."""
+        start = self.ordinals.get(outbound_date)
+        if start is None:
+            start = to_ordinal(outbound_date)
+        last = to_ordinal(last_date) if last_date else None
+        for stay in range(min_stay, max_stay + 1):
+            ordinal = start + stay
+            if last is not None and ordinal > last:
+                break
+            return_date = self.by_ordinal.get(ordinal)
+            if return_date is not None:
+                yield return_date, stay
+
+def pair_round_trips(outbound_dates, return_dates, min_stay, max_stay, last_date=None):
+    """
+    Yield (outbound_date, return_date, stay) for every outbound/return pair whose
+    stay is within [min_stay, max_stay], outbound dates in chronological order.
+    Cost is O(len(outbound_dates) * (max_stay - min_stay + 1)).
+    """
+    returns = return_dates if isinstance(return_dates, DateIndex) else DateIndex(return_dates)
+    outbound = outbound_dates if isinstance(outbound_dates, DateIndex) else DateIndex(outbound_dates)
+    for outbound_date in outbound.sorted_dates():
+        for return_date, stay in returns.returns_for(outbound_date, min_stay, max_stay, last_date):
+            yield outbound_date, return_date, stay
+
+@tracing.span("pairing")
+def cheapest_round_trips(outbound_prices, return_prices, min_stay, max_stay, k=DEFAULT_TOP_K, last_date=None):
+    """
+    Return the k cheapest (total, outbound_date, return_date, stay) combinations,
+    cheapest first. Prices are {iso_date: price}; only k entries are ever kept
+    in memory, whatever the number of pairs.
+    """
+    heap = []  # max-heap on total through negated prices
+    for outbound_date, return_date, stay in pair_round_trips(outbound_prices, return_prices, min_stay, max_stay, last_date):
+        total = outbound_prices[outbound_date] + return_prices[return_date]
+        entry = (-total, outbound_date, return_date, stay)
+        if len(heap) < k:
+            heapq.heappush(heap, entry)
+        elif entry > heap[0]:
+            heapq.heapreplace(heap, entry)
+    return sorted((-neg_total, outbound_date, return_date, stay) for neg_total, outbound_date, return_date, stay in heap)
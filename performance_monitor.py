@@ -1,124 +1,225 @@
 #!/usr/bin/env python3
 """
-Performance monitoring script for the Telegram Flight Bot
+Performance monitoring script for the Telegram Flight Bot.
+
+Samples CPU, RSS and USS of a process and all its descendants (headless Chrome,
+chromedriver, the Selenium Wire proxy), broken down by process type, and
+streams one JSON line per sample so memory stays bounded however long it runs.
+
+    python performance_monitor.py app [app.py args...]
+    python performance_monitor.py --interval 0.5 stats --source db
+    python performance_monitor.py --pid 1234 --interval 5
 """
-import psutil
-import time
-import json
+import os
 import sys
+import json
+import time
+import argparse
 import subprocess
 from datetime import datetime
+import psutil
 
-def monitor_process(pid, output_file="performance_metrics.json"):
-    """Monitor a process and collect performance metrics"""
+CHECKOUT_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS = {"app": "app.py", "stats": "stats.py"}
+MB = 1024 * 1024
+
+def classify(proc):
+    """Process type used to attribute usage: python, chrome[:<type>], chromedriver, proxy or other."""
     try:
-        process = psutil.Process(pid)
-        start_time = time.time()
-        start_cpu_time = process.cpu_times()
-        start_memory = process.memory_info()
-        
-        metrics = {
-            "start_time": datetime.now().isoformat(),
-            "pid": pid,
-            "command": " ".join(process.cmdline()),
-            "samples": []
-        }
-        
-        print(f"Monitoring process {pid}: {process.name()}")
-        print("Time\t\tCPU%\tMemory(MB)\tThreads\tFiles")
-        print("-" * 60)
-        
-        sample_count = 0
-        while process.is_running():
+        name = proc.name().lower()
+        cmdline = proc.cmdline()
+    except (psutil.NoSuchProcess, psutil.AccessDenied):
+        return "other"
+    if "chromedriver" in name:
+        return "chromedriver"
+    if "chrome" in name or "chromium" in name:
+        # Renderer, GPU, utility... helpers carry their role in --type=
+        role = next((arg.split("=", 1)[1] for arg in cmdline if arg.startswith("--type=")), None)
+        return f"chrome:{role}" if role else "chrome"
+    if "mitm" in name or any("seleniumwire" in arg or "mitmproxy" in arg for arg in cmdline[1:]):
+        return "proxy"
+    if "python" in name:
+        return "python"
+    return "other"
+
+class TreeSampler:
+    """
+    Samples a process tree. psutil.Process objects are kept between samples:
+    cpu_percent() measures since the previous call on the same object.
+    """
+    def __init__(self, root, uss=True):
+        self.root = root
+        self.uss = uss
+        self._procs = {}
+        self._types = {}
+
+    def _tree(self):
+        try:
+            children = self.root.children(recursive=True)
+        except psutil.NoSuchProcess:
+            children = []
+        current = {}
+        for proc in [self.root] + children:
+            known = self._procs.get(proc.pid)
+            if known is None:
+                try:
+                    # First cpu_percent() call only starts the measurement
+                    proc.cpu_percent(None)
+                    kind = classify(proc)
+                except (psutil.NoSuchProcess, psutil.AccessDenied):
+                    # Short-lived helper (Chrome renderers, utilities) gone since children()
+                    continue
+                known = proc
+                self._types[proc.pid] = kind
+            current[proc.pid] = known
+        self._types = {pid: self._types[pid] for pid in current}
+        self._procs = current
+        return current
+
+    def sample(self):
+        by_type = {}
+        totals = {"cpu_percent": 0.0, "rss_mb": 0.0, "uss_mb": 0.0, "threads": 0}
+        for pid, proc in self._tree().items():
             try:
-                # Get current metrics
-                cpu_percent = process.cpu_percent(interval=1)
-                memory_info = process.memory_info()
-                memory_mb = memory_info.rss / 1024 / 1024
-                num_threads = process.num_threads()
-                num_fds = len(process.open_files()) if hasattr(process, 'open_files') else 0
-                
-                timestamp = time.time() - start_time
-                
-                sample = {
-                    "timestamp": timestamp,
-                    "cpu_percent": cpu_percent,
-                    "memory_mb": memory_mb,
-                    "memory_bytes": memory_info.rss,
-                    "num_threads": num_threads,
-                    "num_files": num_fds
-                }
-                
-                metrics["samples"].append(sample)
-                
-                # Print current status
-                print(f"{timestamp:7.1f}s\t{cpu_percent:5.1f}%\t{memory_mb:8.1f}\t{num_threads:5d}\t{num_fds:5d}")
-                
-                sample_count += 1
-                time.sleep(2)  # Sample every 2 seconds
-                
+                with proc.oneshot():
+                    if proc.status() == psutil.STATUS_ZOMBIE:
+                        continue
+                    cpu = proc.cpu_percent(None)
+                    threads = proc.num_threads()
+                    if self.uss:
+                        try:
+                            memory = proc.memory_full_info()
+                            uss = memory.uss
+                        except psutil.AccessDenied:
+                            memory, uss = proc.memory_info(), 0
+                    else:
+                        memory, uss = proc.memory_info(), 0
             except (psutil.NoSuchProcess, psutil.AccessDenied):
-                break
-        
-        # Calculate final metrics
-        end_time = time.time()
-        end_cpu_time = process.cpu_times() if process.is_running() else None
-        
-        metrics["end_time"] = datetime.now().isoformat()
-        metrics["total_runtime"] = end_time - start_time
-        metrics["total_samples"] = sample_count
-        
-        if metrics["samples"]:
-            metrics["peak_memory_mb"] = max(s["memory_mb"] for s in metrics["samples"])
-            metrics["avg_cpu_percent"] = sum(s["cpu_percent"] for s in metrics["samples"]) / len(metrics["samples"])
-            metrics["max_threads"] = max(s["num_threads"] for s in metrics["samples"])
-            metrics["max_files"] = max(s["num_files"] for s in metrics["samples"])
-        
-        # Save metrics to file
-        with open(output_file, 'w') as f:
-            json.dump(metrics, f, indent=2)
-        
-        print(f"\nProcess completed. Metrics saved to {output_file}")
-        print(f"Total runtime: {metrics['total_runtime']:.2f} seconds")
-        if metrics["samples"]:
-            print(f"Peak memory usage: {metrics['peak_memory_mb']:.1f} MB")
-            print(f"Average CPU usage: {metrics['avg_cpu_percent']:.1f}%")
-        
-        return metrics
-        
+                continue
+            entry = by_type.setdefault(self._types[pid], {"processes": 0, "cpu_percent": 0.0, "rss_mb": 0.0, "uss_mb": 0.0})
+            entry["processes"] += 1
+            entry["cpu_percent"] += cpu
+            entry["rss_mb"] += memory.rss / MB
+            entry["uss_mb"] += uss / MB
+            totals["cpu_percent"] += cpu
+            totals["rss_mb"] += memory.rss / MB
+            totals["uss_mb"] += uss / MB
+            totals["threads"] += threads
+        totals["processes"] = sum(entry["processes"] for entry in by_type.values())
+        totals["by_type"] = by_type
+        return totals
+
+class Summary:
+    """Running peaks and averages, so nothing but the current sample is kept in memory."""
+    def __init__(self):
+        self.samples = 0
+        self.cpu_sum = 0.0
+        self.peak = {"cpu_percent": 0.0, "rss_mb": 0.0, "uss_mb": 0.0, "processes": 0, "threads": 0}
+        self.peak_by_type = {}
+
+    def add(self, sample):
+        self.samples += 1
+        self.cpu_sum += sample["cpu_percent"]
+        for key in self.peak:
+            self.peak[key] = max(self.peak[key], sample[key])
+        for kind, entry in sample["by_type"].items():
+            peak = self.peak_by_type.setdefault(kind, {"processes": 0, "cpu_percent": 0.0, "rss_mb": 0.0, "uss_mb": 0.0})
+            for key in peak:
+                peak[key] = max(peak[key], entry[key])
+
+    def as_dict(self):
+        return {
+            "total_samples": self.samples,
+            "avg_cpu_percent": self.cpu_sum / self.samples if self.samples else 0,
+            "peak": self.peak,
+            "peak_by_type": self.peak_by_type,
+        }
+
+def _alive(process):
+    try:
+        return process.is_running() and process.status() != psutil.STATUS_ZOMBIE
+    except psutil.NoSuchProcess:
+        return False
+
+def monitor_process(pid, output_file="performance_metrics.jsonl", interval=2.0, uss=True):
+    """Sample the tree rooted at pid every `interval` seconds until it exits. Returns the summary."""
+    try:
+        process = psutil.Process(pid)
+        command = " ".join(process.cmdline())
     except psutil.NoSuchProcess:
         print(f"Process {pid} not found")
         return None
-    except Exception as e:
-        print(f"Error monitoring process: {e}")
-        return None
 
-def run_app_with_monitoring():
-    """Run the app.py script and monitor its performance"""
-    print("Starting app.py with performance monitoring...")
-    
-    # Start the app process
-    cmd = ["/usr/local/bin/python3", "app.py"]
-    process = subprocess.Popen(cmd, cwd="/Users/esemb/Desktop/code/telegram-bot-pasajes")
-    
+    sampler = TreeSampler(process, uss=uss)
+    summary = Summary()
+    start_time = time.time()
+    print(f"Monitoring process tree of {pid}: {process.name()} (every {interval}s, samples in {output_file})")
+    print("Time\t\tCPU%\tRSS(MB)\tUSS(MB)\tProcs\tTop type")
+    print("-" * 70)
+    with open(output_file, "w") as out:
+        out.write(json.dumps({"start_time": datetime.now().isoformat(), "pid": pid, "command": command,
+                              "interval": interval}) + "\n")
+        # Prime cpu_percent() so the first sample has a baseline
+        sampler.sample()
+        while True:
+            time.sleep(interval)
+            if not _alive(process):
+                break
+            sample = sampler.sample()
+            if not sample["processes"]:
+                break
+            sample["timestamp"] = round(time.time() - start_time, 3)
+            summary.add(sample)
+            out.write(json.dumps(sample) + "\n")
+            out.flush()
+            top = max(sample["by_type"].items(), key=lambda item: item[1]["rss_mb"])[0]
+            print(f"{sample['timestamp']:7.1f}s\t{sample['cpu_percent']:5.1f}%\t{sample['rss_mb']:7.1f}\t"
+                  f"{sample['uss_mb']:7.1f}\t{sample['processes']:5d}\t{top}")
+
+        result = summary.as_dict()
+        result.update(end_time=datetime.now().isoformat(), total_runtime=time.time() - start_time)
+        out.write(json.dumps({"summary": result}) + "\n")
+
+    print(f"\nProcess completed. Samples saved to {output_file}")
+    print(f"Total runtime: {result['total_runtime']:.2f} seconds")
+    if summary.samples:
+        print(f"Peak tree RSS: {result['peak']['rss_mb']:.1f} MB | USS: {result['peak']['uss_mb']:.1f} MB")
+        print(f"Average CPU usage: {result['avg_cpu_percent']:.1f}%")
+        for kind, peak in sorted(result["peak_by_type"].items(), key=lambda item: -item[1]["rss_mb"]):
+            print(f"  {kind:16s} peak {peak['rss_mb']:8.1f} MB RSS  {peak['uss_mb']:8.1f} MB USS  "
+                  f"{peak['cpu_percent']:6.1f}% CPU  {peak['processes']} procs")
+    return result
+
+def run_with_monitoring(script, script_args, output_file, interval, uss=True):
+    """Launch app.py or stats.py from this checkout with the current interpreter and monitor it."""
+    cmd = [sys.executable, SCRIPTS[script]] + script_args
+    print(f"Starting {' '.join(cmd)} in {CHECKOUT_DIR} with performance monitoring...")
+    process = subprocess.Popen(cmd, cwd=CHECKOUT_DIR)
     print(f"Started process with PID: {process.pid}")
-    
-    # Monitor the process
     try:
-        metrics = monitor_process(process.pid)
-        process.wait()  # Wait for process to complete
+        metrics = monitor_process(process.pid, output_file, interval, uss)
+        process.wait()
         return metrics, process.returncode
     except KeyboardInterrupt:
         print("\nInterrupted by user")
         process.terminate()
+        process.wait()
         return None, -1
 
 if __name__ == "__main__":
-    if len(sys.argv) > 1 and sys.argv[1].isdigit():
-        # Monitor existing process
-        pid = int(sys.argv[1])
-        monitor_process(pid)
+    parser = argparse.ArgumentParser(description="Monitor CPU/memory of the bot and its browser/proxy children.")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("script", nargs="?", choices=sorted(SCRIPTS), help="script of this checkout to launch and monitor")
+    target.add_argument("--pid", type=int, help="monitor an already running process")
+    parser.add_argument("--interval", type=float, default=2.0, help="seconds between samples")
+    parser.add_argument("--output", default="performance_metrics.jsonl", help="JSONL file for the samples")
+    parser.add_argument("--no-uss", action="store_true", help="skip USS (cheaper: no per-process memory map scan)")
+    # Everything after the script name is passed through to it untouched
+    argv = sys.argv[1:]
+    split = next((i + 1 for i, arg in enumerate(argv) if arg in SCRIPTS), len(argv))
+    args, script_args = parser.parse_args(argv[:split]), argv[split:]
+    if args.pid:
+        monitor_process(args.pid, args.output, args.interval, not args.no_uss)
     else:
-        # Run and monitor app.py
-        metrics, return_code = run_app_with_monitoring()
-        print(f"\nApp.py finished with return code: {return_code}")
+        metrics, return_code = run_with_monitoring(args.script, script_args, args.output, args.interval, not args.no_uss)
+        print(f"\n{SCRIPTS[args.script]} finished with return code: {return_code}")
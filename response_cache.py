@@ -0,0 +1,109 @@
+"""
+Persistent cache of provider responses, shared by app.py and stats.py.
+Entries are keyed by normalized URL, expire after a per-host TTL and the
+least recently used ones are evicted once the cache grows past CACHE_MAX_BYTES.
+"""
+import os
+import time
+import sqlite3
+import logging
+import threading
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from config import CACHE_TTL, CACHE_MAX_BYTES
+
+CACHE_FILE = os.getenv("HTTP_CACHE_FILE", "http_cache.db")
+
+_conn = None
+_lock = threading.Lock()
+MEMO_PREFIX = "memo://"  # keys of values the bot derives itself, not HTTP responses
+
+_enabled = True
+_memo_enabled = True
+
+def disable(memo=True):
+    """
+    Turn get() into a miss and put() into a no-op for provider responses (used
+    while recording or replaying traffic); with memo=True for memo:// entries too.
+    """
+    global _enabled, _memo_enabled
+    _enabled = False
+    if memo:
+        _memo_enabled = False
+
+def _active(url):
+    return _memo_enabled if url.startswith(MEMO_PREFIX) else _enabled
+
+def _get_conn():
+    global _conn
+    if _conn is None:
+        _conn = sqlite3.connect(CACHE_FILE, check_same_thread=False)
+        _conn.execute("PRAGMA journal_mode=WAL")
+        _conn.execute("PRAGMA synchronous=NORMAL")
+        with _conn:
+            _conn.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    host TEXT,
+                    body BLOB,
+                    size INTEGER,
+                    fetched_at REAL,
+                    last_access REAL
+                )
+            """)
+            _conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_last_access ON responses (last_access)")
+    return _conn
+
+def normalize_url(url):
+    """Lowercase scheme/host, drop the fragment and sort query keys (repeated keys keep their order)."""
+    parts = urlsplit(url)
+    query = sorted(parse_qsl(parts.query, keep_blank_values=True), key=lambda kv: kv[0])
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, urlencode(query), ""))
+
+def ttl_for(url):
+    return CACHE_TTL.get(urlsplit(url).hostname or "", 0)
+
+def get(url, ttl=None):
+    """Return the cached body of url if it is younger than ttl (default: the host TTL), else None."""
+    ttl = ttl_for(url) if ttl is None else ttl
+    if ttl <= 0 or not _active(url):
+        return None
+    key = normalize_url(url)
+    now = time.time()
+    with _lock:
+        conn = _get_conn()
+        row = conn.execute("SELECT body, fetched_at FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None or now - row[1] > ttl:
+            return None
+        with conn:
+            conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+    return row[0]
+
+def put(url, body):
+    """Store a response body, evicting least recently used entries if the cache is too big."""
+    if not _active(url):
+        return
+    key = normalize_url(url)
+    now = time.time()
+    with _lock:
+        conn = _get_conn()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, host, body, size, fetched_at, last_access) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, urlsplit(url).hostname, body, len(body), now, now)
+            )
+            _evict(conn)
+
+def _evict(conn):
+    total = conn.execute("SELECT IFNULL(SUM(size), 0) FROM responses").fetchone()[0]
+    if total <= CACHE_MAX_BYTES:
+        return
+    # Free down to 90% so we do not evict again on the next put
+    target = total - int(CACHE_MAX_BYTES * 0.9)
+    freed, keys = 0, []
+    for key, size in conn.execute("SELECT key, size FROM responses ORDER BY last_access"):
+        keys.append((key,))
+        freed += size
+        if freed >= target:
+            break
+    conn.executemany("DELETE FROM responses WHERE key = ?", keys)
+    logging.info("Response cache: evicted %d entries (%d bytes)", len(keys), freed)
@@ -0,0 +1,71 @@
+"""
+Incremental scan scheduling. A unit is one (destination, "YYYY-MM") of a provider;
+every scan records a fingerprint of its prices, and an exponential average of
+how often the fingerprint changed (the unit's volatility) sets how long until
+the next refresh, shortened further for months that are close.
+"""
+import json
+import time
+import hashlib
+import logging
+from datetime import date
+from config import SCAN_SCHEDULE
+import db
+
+def month_key(year, month):
+    return f"{year}-{month:02d}"
+
+def fingerprint(prices):
+    """Stable hash of an iterable of (date, price) pairs."""
+    return hashlib.sha1(json.dumps(sorted(prices)).encode()).hexdigest()
+
+def refresh_interval(volatility, month, today=None):
+    """Seconds between scans of a unit with this volatility (0..1) for month "YYYY-MM"."""
+    today = today or date.today()
+    days_ahead = max(0, (date.fromisoformat(month + "-01") - today).days)
+    # 0.25 for months already started, up to 1 beyond horizon_days
+    proximity = 0.25 + 0.75 * min(1, days_ahead / SCAN_SCHEDULE["horizon_days"])
+    span = SCAN_SCHEDULE["max_interval"] - SCAN_SCHEDULE["min_interval"]
+    return SCAN_SCHEDULE["min_interval"] + span * (1 - volatility) * proximity
+
+class ScanSchedule:
+    """Change history of one provider's units for one scan."""
+    def __init__(self, provider, incremental=True):
+        self.provider = provider
+        self.incremental = incremental
+        self.units = db.load_scan_units(provider)
+
+    def priority(self, unit, now=None):
+        """Elapsed time over refresh interval; the unit is due at 1 or more."""
+        state = self.units.get(unit)
+        if state is None or state[0] is None:
+            return float('inf')
+        last_scan, _, volatility = state
+        return ((now or time.time()) - last_scan) / refresh_interval(volatility, unit[1])
+
+    def due(self, units):
+        """The due units, most urgent first. Every unit when the scan is not incremental."""
+        units = list(units)
+        if not self.incremental:
+            return units
+        now = time.time()
+        ranked = sorted(((self.priority(unit, now), unit) for unit in units), key=lambda pu: pu[0], reverse=True)
+        due = [unit for priority, unit in ranked if priority >= 1]
+        limit = SCAN_SCHEDULE["max_units_per_run"]
+        if limit is not None:
+            due = due[:limit]
+        logging.info("%s: %d de %d unidades (destino, mes) a refrescar", self.provider, len(due), len(units))
+        return due
+
+    def record(self, unit, unit_fingerprint):
+        """Store a completed scan of unit, updating its volatility."""
+        previous = self.units.get(unit)
+        now = time.time()
+        if previous is None or previous[1] is None:
+            changed, volatility = False, 0.5  # no history yet: assume moderately volatile
+        else:
+            changed = previous[1] != unit_fingerprint
+            alpha = SCAN_SCHEDULE["volatility_alpha"]
+            volatility = (1 - alpha) * previous[2] + alpha * changed
+        self.units[unit] = (now, unit_fingerprint, volatility)
+        db.save_scan_unit(self.provider, unit[0], unit[1], now, unit_fingerprint, volatility, changed)
@@ -1,29 +1,159 @@
 from .base_provider import BaseProvider
-import requests
-from datetime import datetime, timedelta
-from get_aerolineas_token import get_token_with_selenium_wire
+import json
+import logging
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from get_aerolineas_token import get_token
+import http_client
+import response_cache
+import tracing
+from config import HOST_CONCURRENCY, VALIDATION_CACHE_TTL, AEROLINEAS_API_URL, AEROLINEAS_HOST
+from pairing import cheapest_round_trips, to_ordinal, DEFAULT_STAY_RANGE, DEFAULT_TOP_K
+from flights import Flight, ROUND_TRIP, register_renderer
+from scan_schedule import ScanSchedule, fingerprint
 
 EXCHANGE_RATE = {"ARS_USD": 1285}
+AIRLINE = "Aerolíneas Argentinas"
+OFFERS_URL = AEROLINEAS_API_URL + "/v1/flights/offers?adt=1&inf=0&chd=0&flexDates=true&cabinClass=Economy&flightType=ROUND_TRIP&leg=BUE-{dest_code}-{ida}&leg={dest_code}-BUE-{vuelta}"
+# Days before/after the anchor covered by a flexDates response, until one is observed
+DEFAULT_FLEX_WINDOW = (3, 3)
+FLEX_WINDOW_KEY = "memo://aerolineas-flex-window"
+FLEX_WINDOW_TTL = 7 * 24 * 60 * 60
+ARCHIVE_FLEX_WINDOW = "aerolineas_flex_window"
+
+class TokenExpiredError(Exception):
+    """Raised when api.aerolineas.com.ar rejects the bearer token (HTTP 401)."""
+
+class TokenSession:
+    """Holds the bearer token for one scan and refreshes it once on a 401."""
+    def __init__(self):
+        self.token = get_token()
+        self.refreshed = False
+        self._lock = threading.Lock()
+
+    def call(self, fn, *args):
+        """
+        Call fn(token, *args), retrying once with a fresh token if it raises
+        TokenExpiredError. Safe to use from several threads: only the first
+        401 refreshes, the others retry with the token it obtained.
+        """
+        token = self.token
+        try:
+            return fn(token, *args)
+        except TokenExpiredError:
+            with self._lock:
+                if self.token == token:
+                    if self.refreshed:
+                        raise
+                    logging.warning("Token de Aerolíneas rechazado (401), renovando...")
+                    self.refreshed = True
+                    self.token = get_token(invalid_token=token)
+                if not self.token:
+                    raise
+            return fn(self.token, *args)
 
 def get_calendar_offers(token, url):
+    """calendarOffers of a flexDates query ({} if nothing is on sale), or None if the request failed."""
     headers = {
         "Authorization": f"Bearer {token}",
         "User-Agent": "Mozilla/5.0",
         "Accept": "application/json"
     }
     try:
-        res = requests.get(url, headers=headers, timeout=15)
+        res = http_client.get(url, headers=headers, cache=True)
+        if res.status_code == 401:
+            raise TokenExpiredError(url)
         res.raise_for_status()
         data = res.json()
         return data.get("calendarOffers", {})
-    except Exception:
-        return {}
+    except TokenExpiredError:
+        raise
+    except Exception as e:
+        logging.warning("Aerolíneas offers %s unavailable: %s", url, e)
+        return None
+
+def offers_url(dest_code, ida_anchor, vuelta_anchor):
+    return OFFERS_URL.format(dest_code=dest_code, ida=ida_anchor.replace("-", ""), vuelta=vuelta_anchor.replace("-", ""))
+
+def get_flex_window():
+    """
+    (days_before, days_after) around the anchor returned by flexDates queries, as
+    last observed. A replay plans with the window of the recorded run.
+    """
+    if http_client.is_replaying():
+        return tuple(http_client.archived_setting(ARCHIVE_FLEX_WINDOW) or DEFAULT_FLEX_WINDOW)
+    body = response_cache.get(FLEX_WINDOW_KEY, ttl=FLEX_WINDOW_TTL)
+    window = tuple(json.loads(body)) if body else DEFAULT_FLEX_WINDOW
+    http_client.annotate_archive(ARCHIVE_FLEX_WINDOW, list(window))
+    return window
+
+def observe_flex_window(anchor_date, offers):
+    """Widen the stored flex window with the departures returned for anchor_date."""
+    # A replay keeps the window of the recorded run
+    if http_client.is_replaying():
+        return
+    departures = [to_ordinal(o["departure"]) for o in offers if isinstance(o, dict) and o.get("departure")]
+    if not departures:
+        return
+    anchor = to_ordinal(anchor_date)
+    before, after = max(0, anchor - min(departures)), max(0, max(departures) - anchor)
+    stored = response_cache.get(FLEX_WINDOW_KEY, ttl=FLEX_WINDOW_TTL)
+    if stored:
+        stored_before, stored_after = json.loads(stored)
+        if before <= stored_before and after <= stored_after:
+            return
+        before, after = max(before, stored_before), max(after, stored_after)
+    logging.info("Ventana flexDates de Aerolíneas observada: -%d/+%d días", before, after)
+    response_cache.put(FLEX_WINDOW_KEY, json.dumps([before, after]).encode())
+
+def plan_anchor_dates(start_date, end_date, window=None):
+    """
+    Minimal list of anchor dates whose flexDates windows cover every day of
+    [start_date, end_date] exactly once. Windows sit on a fixed grid of
+    ordinals (each starts at a multiple of its width), so overlapping ranges ask
+    for the same URLs and share cached responses; the first and last windows
+    may run past the range.
+    """
+    before, after = window or get_flex_window()
+    width = before + after + 1
+    first, last = to_ordinal(start_date), to_ordinal(end_date)
+    return [date.fromordinal(ordinal + before).isoformat() for ordinal in range(first - first % width, last + 1, width)]
+
+def unit_for(dest_code, anchor, start_date, end_date):
+    """(destination, month) unit of a query: the anchor's month, kept within the scanned range."""
+    return dest_code, min(max(anchor, start_date), end_date)[:7]
+
+def plan_return_offsets(stay_range=DEFAULT_STAY_RANGE, window=None):
+    """
+    Days from the outbound anchor to each return anchor. Their windows tile
+    [min_stay - before, max_stay + after], so every stay in stay_range can pair
+    with every outbound day of the anchor's window.
+    """
+    before, after = window or get_flex_window()
+    width = before + after + 1
+    min_stay, max_stay = stay_range
+    return list(range(min_stay, max_stay + before + after + 1, width))
+
+def plan_offers_queries(destinations, start_date, end_date, stay_range=DEFAULT_STAY_RANGE, window=None):
+    """(dest_code, ida_anchor, vuelta_anchor) for every flexDates query needed."""
+    window = window or get_flex_window()
+    anchors = plan_anchor_dates(start_date, end_date, window)
+    offsets = plan_return_offsets(stay_range, window)
+    return [
+        (dest_code, anchor, date.fromordinal(to_ordinal(anchor) + offset).isoformat())
+        for dest_code in destinations
+        for anchor in anchors
+        for offset in offsets
+    ]
 
 def validate_real_ticket_aerolineas(token, dest_code, ida_date, vuelta_date):
+    """True if the round trip can really be booked, False if not, None if the check failed."""
     leg1 = f"BUE-{dest_code}-{ida_date.replace('-', '')}"
     leg2 = f"{dest_code}-BUE-{vuelta_date.replace('-', '')}"
     url = (
-        "https://api.aerolineas.com.ar/v1/flights/offers"
+        f"{AEROLINEAS_API_URL}/v1/flights/offers"
         f"?adt=1&inf=0&chd=0&flexDates=false&cabinClass=Economy&flightType=ROUND_TRIP"
         f"&leg={leg1}&leg={leg2}"
     )
@@ -33,85 +163,156 @@ def validate_real_ticket_aerolineas(token, dest_code, ida_date, vuelta_date):
         "Accept": "application/json"
     }
     try:
-        res = requests.get(url, headers=headers, timeout=15)
+        res = http_client.get(url, headers=headers)
+        if res.status_code == 401:
+            raise TokenExpiredError(url)
         res.raise_for_status()
         data = res.json()
         if data.get("calendarOffers", {}).get("0") and data.get("calendarOffers", {}).get("1"):
             return True
         if data.get("offers"):
             return True
-    except Exception:
-        pass
+    except TokenExpiredError:
+        raise
+    except Exception as e:
+        logging.warning("Aerolíneas validation %s unavailable: %s", url, e)
+        return None
     return False
 
+def _validation_key(dest_code, ida_date, vuelta_date, valid):
+    return f"memo://aerolineas-validation/{'valid' if valid else 'invalid'}/{dest_code}/{ida_date}/{vuelta_date}"
+
+def validate_cached(session, dest_code, ida_date, vuelta_date):
+    """
+    validate_real_ticket_aerolineas memoized in response_cache: positive results
+    are reused for VALIDATION_CACHE_TTL["valid"] seconds and negative ones for
+    VALIDATION_CACHE_TTL["invalid"]. Failed checks are not cached. While
+    recording every check is sent, so the replay finds it in the archive.
+    """
+    for valid in (True, False) if not http_client.is_recording() else ():
+        ttl = VALIDATION_CACHE_TTL["valid" if valid else "invalid"]
+        if response_cache.get(_validation_key(dest_code, ida_date, vuelta_date, valid), ttl=ttl) is not None:
+            return valid
+    is_real = session.call(validate_real_ticket_aerolineas, dest_code, ida_date, vuelta_date)
+    if is_real is not None:
+        response_cache.put(_validation_key(dest_code, ida_date, vuelta_date, is_real), b"1")
+    return bool(is_real)
+
+@tracing.span("validation")
+def validate_candidates(session, dest_code, candidates, max_workers=None):
+    """
+    Validate (total, ida_date, vuelta_date, stay) candidates concurrently.
+    Returns the real ones, in the order they were given.
+    """
+    if not candidates:
+        return []
+    if max_workers is None:
+        max_workers = HOST_CONCURRENCY.get(AEROLINEAS_HOST, 1)
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(candidates)))) as executor:
+        verdicts = list(executor.map(lambda c: validate_cached(session, dest_code, c[1], c[2]), candidates))
+    return [candidate for candidate, is_real in zip(candidates, verdicts) if is_real]
+
+def web_link(flight):
+    leg = f"leg=BUE-{flight.destination}-{flight.date.replace('-', '')}"
+    if flight.is_round_trip:
+        return f"https://www.aerolineas.com.ar/flights-offers?adt=1&inf=0&chd=0&flexDates=false&cabinClass=Economy&flightType=ROUND_TRIP&{leg}&leg={flight.destination}-BUE-{flight.return_date.replace('-', '')}"
+    return f"https://www.aerolineas.com.ar/flights-offers?adt=1&inf=0&chd=0&flexDates=false&cabinClass=Economy&flightType=ONE_WAY&{leg}"
+
+def render_message(flight):
+    if flight.is_round_trip:
+        return f"✈️ <b>Aerolíneas Argentinas</b> | {flight.destination}{' (VALIDADO)' if flight.validated else ''}\n📅 Ida: <b>{flight.date}</b> | Vuelta: <b>{flight.return_date}</b>\n⏳ Duración: <b>{flight.stay} días</b>\n💸 Ida: <b>${flight.price}</b> | Vuelta: <b>${flight.return_price}</b>\n💰 Total: <b>${flight.total_price}</b>\n<a href=\"{web_link(flight)}\">Link</a>"
+    return f"✈️ <b>Aerolíneas Argentinas</b> | {flight.destination}\n📅 Ida: <b>{flight.date}</b>\n💸 Precio solo ida: <b>${flight.price}</b>\n<a href=\"{web_link(flight)}\">Link</a>"
+
+register_renderer(AIRLINE, web_link, render_message)
+
 class AerolineasProvider(BaseProvider):
-    def search_flights(self, origin, destination, start_date, end_date, notify_threshold=None):
-        results = []
-        token = get_token_with_selenium_wire()
-        if not token:
-            return results
+    def iter_flights(self, origin, destination, start_date, end_date, notify_threshold=None,
+                     stay_range=DEFAULT_STAY_RANGE, top_k=DEFAULT_TOP_K, incremental=False):
+        schedule = ScanSchedule("aerolineas", incremental=incremental)
+        queries = self._plan(destination, start_date, end_date, stay_range, schedule)
+        # The token may need headless Chrome: only get it when something is due
+        if not queries:
+            return
+        session = TokenSession()
+        if not session.token:
+            return
+        try:
+            yield from self._scan(session, queries, start_date, end_date, notify_threshold, stay_range, top_k, schedule)
+        except TokenExpiredError as e:
+            logging.error("Token de Aerolíneas rechazado incluso tras renovarlo (%s). Se detiene la búsqueda.", e)
+
+    def _plan(self, destination, start_date, end_date, stay_range, schedule):
+        """The flexDates queries of the units that are due."""
+        window = get_flex_window()
+        queries = plan_offers_queries(destination, start_date, end_date, stay_range, window)
+        logging.info("Aerolíneas: %d consultas flexDates planificadas (%d vueltas por ida, ventana -%d/+%d días)",
+                     len(queries), len(plan_return_offsets(stay_range, window)), *window)
+        # A unit is (destination, month of the anchor, see unit_for); only the queries of due units are sent
+        due = set(schedule.due(dict.fromkeys(unit_for(dest_code, anchor, start_date, end_date) for dest_code, anchor, _ in queries)))
+        return [query for query in queries if unit_for(query[0], query[1], start_date, end_date) in due]
+
+    def _scan(self, session, queries, start_date, end_date, notify_threshold, stay_range, top_k, schedule):
         # If notify_threshold is not provided, use a high value to avoid validation
         if notify_threshold is None:
             notify_threshold = float('inf')
-        for dest_code in destination:
-            d = datetime.strptime(start_date, "%Y-%m-%d").replace(day=1)
-            end_dt = datetime.strptime(end_date, "%Y-%m-%d")
-            seen = set()
-            while d <= end_dt:
-                leg1 = f"BUE-{dest_code}-{d.strftime('%Y%m%d')}"
-                leg2 = f"{dest_code}-BUE-{d.strftime('%Y%m%d')}"
-                url = f"https://api.aerolineas.com.ar/v1/flights/offers?adt=1&inf=0&chd=0&flexDates=true&cabinClass=Economy&flightType=ROUND_TRIP&leg={leg1}&leg={leg2}"
-                offers = get_calendar_offers(token, url)
-
-                ida_map, vuelta_map = {}, {}
-                for offer in offers.get("0", []):
-                    if offer and isinstance(offer, dict) and not offer.get("soldOut") and isinstance(offer.get("offerDetails"), dict) and offer["offerDetails"].get("fare"):
-                        price_usd = int(offer["offerDetails"]["fare"].get("total") / EXCHANGE_RATE["ARS_USD"])
-                        ida_map[offer.get("departure")] = {"price": price_usd}
-                        web_link = f"https://www.aerolineas.com.ar/flights-offers?adt=1&inf=0&chd=0&flexDates=false&cabinClass=Economy&flightType=ONE_WAY&leg=BUE-{dest_code}-{offer.get('departure').replace('-', '')}"
-                        message = f"✈️ <b>Aerolíneas Argentinas</b> | {dest_code}\n📅 Ida: <b>{offer.get('departure')}</b>\n💸 Precio solo ida: <b>${price_usd}</b>\n<a href=\"{web_link}\">Link</a>"
-                        results.append({
-                            "date": offer.get("departure"),
-                            "price": price_usd,
-                            "destination": dest_code,
-                            "webLink": web_link,
-                            "totalPrice": price_usd,
-                            "airline": "Aerolíneas Argentinas",
-                            "flight_type": "ONE_WAY",
-                            "message": message
-                        })
-
-                for offer in offers.get("1", []):
-                    if offer and isinstance(offer, dict) and not offer.get("soldOut") and isinstance(offer.get("offerDetails"), dict) and offer["offerDetails"].get("fare"):
-                        price_usd = int(offer["offerDetails"]["fare"].get("total") / EXCHANGE_RATE["ARS_USD"])
-                        vuelta_map[offer.get("departure")] = {"price": price_usd}
-
-                for ida_date, ida_info in ida_map.items():
-                    d1 = datetime.strptime(ida_date, "%Y-%m-%d")
-                    vuelta_date = (d1 + timedelta(days=14)).strftime("%Y-%m-%d")
-                    if vuelta_date in vuelta_map:
-                        total_price = ida_info["price"] + vuelta_map[vuelta_date]["price"]
-                        key = (ida_date, vuelta_date, total_price)
-                        if key in seen:
-                            continue
-                        seen.add(key)
-                        # Only validate if under notify threshold
-                        if total_price < notify_threshold:
-                            is_real = validate_real_ticket_aerolineas(token, dest_code, ida_date, vuelta_date)
-                            if is_real:
-                                web_link = f"https://www.aerolineas.com.ar/flights-offers?adt=1&inf=0&chd=0&flexDates=false&cabinClass=Economy&flightType=ROUND_TRIP&leg=BUE-{dest_code}-{d1.strftime('%Y%m%d')}&leg={dest_code}-BUE-{(d1 + timedelta(days=14)).strftime('%Y%m%d')}"
-                                message = f"✈️ <b>Aerolíneas Argentinas</b> | {dest_code}{' (VALIDADO)' if total_price < notify_threshold else ''}\n📅 Ida: <b>{ida_date}</b> | Vuelta: <b>{vuelta_date}</b>\n⏳ Duración: <b>14 días</b>\n💸 Ida: <b>${ida_info['price']}</b> | Vuelta: <b>${vuelta_map[vuelta_date]['price']}</b>\n💰 Total: <b>${total_price}</b>\n<a href=\"{web_link}\">Link</a>"
-                                results.append({
-                                    "date": ida_date,
-                                    "price": ida_info["price"],
-                                    "return_date": vuelta_date,
-                                    "return_price": vuelta_map[vuelta_date]["price"],
-                                    "destination": dest_code,
-                                    "webLink": web_link,
-                                    "totalPrice": total_price,
-                                    "airline": "Aerolíneas Argentinas",
-                                    "flight_type": "ROUND_TRIP",
-                                    "message": message
-                            })
-                d = (d.replace(day=28) + timedelta(days=4)).replace(day=1)
-        return results
+        pending = Counter(unit_for(dest_code, anchor, start_date, end_date) for dest_code, anchor, _ in queries)
+        # Outbound and return prices of each unit, merged across its queries
+        unit_maps = {}
+        unit_prices = {}
+        failed = set()
+        seen = set()
+        for dest_code, anchor, vuelta_anchor in queries:
+            url = offers_url(dest_code, anchor, vuelta_anchor)
+            unit = unit_for(dest_code, anchor, start_date, end_date)
+            offers = session.call(get_calendar_offers, url)
+            if offers is None:
+                # Not recorded as scanned, so the unit stays due for the next run
+                failed.add(unit)
+                offers = {}
+            observe_flex_window(anchor, offers.get("0", []))
+
+            ida_map, vuelta_map = unit_maps.setdefault(unit, ({}, {}))
+            for offer in offers.get("0", []):
+                if offer and isinstance(offer, dict) and not offer.get("soldOut") and isinstance(offer.get("offerDetails"), dict) and offer["offerDetails"].get("fare"):
+                    # The windows at the edges of the range may cover days outside it
+                    if not start_date <= offer.get("departure", "") <= end_date:
+                        continue
+                    price_usd = int(offer["offerDetails"]["fare"].get("total") / EXCHANGE_RATE["ARS_USD"])
+                    ida_map[offer.get("departure")] = min(price_usd, ida_map.get(offer.get("departure"), price_usd))
+                    unit_prices.setdefault(unit, []).append(("0", offer.get("departure"), price_usd))
+                    # Windows of neighbouring anchors may overlap
+                    if (dest_code, offer.get("departure"), price_usd) in seen:
+                        continue
+                    seen.add((dest_code, offer.get("departure"), price_usd))
+                    yield Flight(AIRLINE, dest_code, offer.get("departure"), price_usd, price_usd)
+
+            for offer in offers.get("1", []):
+                if offer and isinstance(offer, dict) and not offer.get("soldOut") and isinstance(offer.get("offerDetails"), dict) and offer["offerDetails"].get("fare"):
+                    price_usd = int(offer["offerDetails"]["fare"].get("total") / EXCHANGE_RATE["ARS_USD"])
+                    vuelta_map[offer.get("departure")] = min(price_usd, vuelta_map.get(offer.get("departure"), price_usd))
+                    unit_prices.setdefault(unit, []).append(("1", offer.get("departure"), price_usd))
+
+            pending[unit] -= 1
+            if pending[unit]:
+                continue
+            # Last query of the unit: record it and pair its top_k cheapest combinations
+            del unit_maps[unit]
+            prices = unit_prices.pop(unit, [])
+            if unit not in failed:
+                schedule.record(unit, fingerprint(prices))
+
+            # Only the top_k cheapest combinations of the unit within the stay window are kept
+            candidates = []
+            for candidate in cheapest_round_trips(ida_map, vuelta_map, *stay_range, k=top_k):
+                key = (dest_code,) + candidate[:3]
+                if key in seen:
+                    continue
+                seen.add(key)
+                # Only validate if under notify threshold
+                if candidate[0] < notify_threshold:
+                    candidates.append(candidate)
+
+            for total_price, ida_date, vuelta_date, stay in validate_candidates(session, dest_code, candidates):
+                yield Flight(AIRLINE, dest_code, ida_date, ida_map[ida_date], total_price,
+                             flight_type=ROUND_TRIP, return_date=vuelta_date, return_price=vuelta_map[vuelta_date],
+                             stay=stay, validated=total_price < notify_threshold)
@@ -1,7 +1,23 @@
-from abc import ABC, abstractmethod
+from abc import ABC
 
 class BaseProvider(ABC):
-    @abstractmethod
-    def search_flights(self, origin, destination, start_date, end_date):
-        """Return a list of flight dicts with standardized keys."""
-        pass
+    """
+    Providers implement iter_flights (preferred, streams results as they are
+    found) or search_flights (builds the whole list); each defaults to the other.
+
+    Results are flights.Flight instances: run_provider_search filters them on
+    total_price and is_round_trip, notifies their rendered message and stores
+    them, so the provider module must register_renderer() for its airline.
+    """
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if cls.iter_flights is BaseProvider.iter_flights and cls.search_flights is BaseProvider.search_flights:
+            raise TypeError(f"{cls.__name__} must implement iter_flights or search_flights")
+
+    def iter_flights(self, origin, destination, start_date, end_date, **kwargs):
+        """Yield flights.Flight objects as soon as they are found."""
+        yield from self.search_flights(origin, destination, start_date, end_date, **kwargs)
+
+    def search_flights(self, origin, destination, start_date, end_date, **kwargs):
+        """Return a list of flights.Flight objects."""
+        return list(self.iter_flights(origin, destination, start_date, end_date, **kwargs))
@@ -1,75 +1,126 @@
 from .base_provider import BaseProvider
-import requests
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from config import HOST_CONCURRENCY, SCAN_SCHEDULE, LEVEL_BASE_URL, LEVEL_HOST
+from pairing import DateIndex, DEFAULT_STAY_RANGE
+from flights import Flight, ROUND_TRIP, register_renderer
+import http_client
+import response_cache
+import tracing
+from scan_schedule import ScanSchedule, month_key, fingerprint
 
 EXCHANGE_RATE = {"EUR_USD": 1.17}
+AIRLINE = "Level"
+CALENDAR_URL = LEVEL_BASE_URL + "/nwe/flights/api/calendar/?triptype=RT&origin=EZE&destination={dest_code}&month={month:02d}&year={year}&currencyCode=USD"
+
+def iter_months(start_date, end_date):
+    """Yield (year, month) for every calendar month touched by the date range."""
+    d = datetime.strptime(start_date, "%Y-%m-%d").replace(day=1)
+    end_dt = datetime.strptime(end_date, "%Y-%m-%d")
+    while d <= end_dt:
+        yield d.year, d.month
+        d = (d.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+def _day_prices(body):
+    return json.loads(body).get("data", {}).get("dayPrices", [])
+
+def fetch_calendar_month(dest_code, year, month):
+    """Return the dayPrices of one destination/month, or None on error."""
+    api_url = CALENDAR_URL.format(dest_code=dest_code, month=month, year=year)
+    try:
+        res = http_client.get(api_url, cache=True)
+        res.raise_for_status()
+        return _day_prices(res.content)
+    except Exception as e:
+        logging.warning("Level calendar %s %d-%02d unavailable: %s", dest_code, year, month, e)
+        return None
+
+def stored_calendar_month(dest_code, year, month):
+    """dayPrices of the last calendar fetched for a unit that is not due, or None if no longer stored."""
+    body = response_cache.get(CALENDAR_URL.format(dest_code=dest_code, month=month, year=year),
+                              ttl=SCAN_SCHEDULE["max_interval"])
+    return _day_prices(body) if body is not None else None
+
+def iter_calendars(destinations, start_date, end_date, max_workers=None, schedule=None):
+    """
+    Fetch every (destination, month) calendar concurrently and yield
+    (dest_code, day_price_map, refreshed_months) as soon as all months of a
+    destination arrived, keeping the cheapest price per day. With a
+    ScanSchedule only due months are fetched; the others are read from the
+    last stored calendar so round trips can still pair across months.
+    """
+    months = list(iter_months(start_date, end_date))
+    units = [(dest_code, year, month) for dest_code in destinations for year, month in months]
+    due = set(schedule.due((d, month_key(y, m)) for d, y, m in units)) if schedule else None
+
+    def load(unit):
+        dest_code, year, month = unit
+        if due is not None and (dest_code, month_key(year, month)) not in due:
+            days = stored_calendar_month(*unit)
+            if days is not None:
+                return days, False
+        return fetch_calendar_month(*unit), True
+
+    if max_workers is None:
+        max_workers = HOST_CONCURRENCY.get(LEVEL_HOST, 1)
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        # map() keeps submission order, so merging matches the sequential scan
+        calendars = executor.map(load, units)
+        for dest_code in destinations:
+            day_price_map = {}
+            refreshed = set()
+            for year, month in months:
+                days, fetched = next(calendars)
+                if fetched:
+                    refreshed.add(month_key(year, month))
+                    if schedule and days is not None:
+                        schedule.record((dest_code, month_key(year, month)),
+                                        fingerprint((day["date"], day.get("price")) for day in days))
+                for day in days or []:
+                    if day.get("price") is not None:
+                        if (day["date"] not in day_price_map) or (day["price"] < day_price_map[day["date"]]["price"]):
+                            day_price_map[day["date"]] = day
+            yield dest_code, day_price_map, refreshed
+
+def web_link(flight):
+    if flight.is_round_trip:
+        return f"https://www.flylevel.com/Flight/Select?culture=es-ES&triptype=RT&o1=EZE&d1={flight.destination}&dd1={flight.date}&ADT=1&CHD=0&INL=0&r=true&mm=false&dd2={flight.return_date}&forcedCurrency=USD&forcedCulture=es-ES&newecom=true&currency=USD"
+    return f"https://www.flylevel.com/Flight/Select?culture=es-ES&triptype=OW&o1=EZE&d1={flight.destination}&dd1={flight.date}&ADT=1&CHD=0&INL=0&r=false&mm=false&forcedCurrency=USD&forcedCulture=es-ES&newecom=true&currency=USD"
+
+def render_message(flight):
+    if flight.is_round_trip:
+        return f"✈️ <b>Level</b> | {flight.destination}\n📅 Ida: <b>{flight.date}</b> | Vuelta: <b>{flight.return_date}</b>\n⏳ Duración: <b>{flight.stay} días</b>\n💸 Ida: <b>${flight.price} USD</b> | Vuelta: <b>${flight.return_price} USD</b>\n💰 Total: <b>${flight.total_price} USD</b>\n<a href=\"{web_link(flight)}\">Link</a>"
+    return f"✈️ <b>Level</b> | {flight.destination}\n📅 Ida: <b>{flight.date}</b>\n💸 Precio solo ida: <b>${flight.price} USD</b>\n<a href=\"{web_link(flight)}\">Link</a>"
+
+register_renderer(AIRLINE, web_link, render_message)
 
 class LevelProvider(BaseProvider):
-    def search_flights(self, origin, destination, start_date, end_date):
-        results = []
+    def iter_flights(self, origin, destination, start_date, end_date, max_workers=None, stay_range=DEFAULT_STAY_RANGE,
+                     incremental=False):
+        min_stay, max_stay = stay_range
+        schedule = ScanSchedule("level", incremental=incremental)
         # destination is a list of airport codes (e.g., ["MAD", "BCN"])
-        for dest_code in destination:
-            day_price_map = {}
-            d = datetime.strptime(start_date, "%Y-%m-%d").replace(day=1)
-            end_dt = datetime.strptime(end_date, "%Y-%m-%d")
-            while d <= end_dt:
-                api_url = f"https://www.flylevel.com/nwe/flights/api/calendar/?triptype=RT&origin=EZE&destination={dest_code}&month={d.month:02d}&year={d.year}&currencyCode=USD"
-                try:
-                    res = requests.get(api_url, headers={"User-Agent": "Mozilla/5.0"}, timeout=15)
-                    res.raise_for_status()
-                    for day in res.json().get("data", {}).get("dayPrices", []):
-                        if day.get("price") is not None:
-                            if (day["date"] not in day_price_map) or (day["price"] < day_price_map[day["date"]]["price"]):
-                                day_price_map[day["date"]] = day
-                except Exception:
+        for dest_code, day_price_map, refreshed in iter_calendars(destination, start_date, end_date, max_workers, schedule):
+            with tracing.span("pairing_index", provider="level"):
+                day_index = DateIndex(day_price_map)
+                # Prices are converted once per day instead of once per pair
+                prices_usd = {day: round(info["price"] * EXCHANGE_RATE["EUR_USD"], 2) for day, info in day_price_map.items()}
+            for outbound_day in day_index.sorted_dates():
+                # ISO dates compare chronologically as strings
+                if not (start_date <= outbound_day <= end_date):
                     continue
-                d = (d.replace(day=28) + timedelta(days=4)).replace(day=1)
-
-            unique_days = sorted(day_price_map.values(), key=lambda x: x["date"])
-            for i, outbound in enumerate(unique_days):
-                outbound_date = datetime.strptime(outbound["date"], "%Y-%m-%d")
-                if not (datetime.strptime(start_date, "%Y-%m-%d") <= outbound_date <= end_dt):
+                # Flights leaving in a month that was not due were already reported
+                if outbound_day[:7] not in refreshed:
                     continue
+                price_out_usd = prices_usd[outbound_day]
 
                 # One-way
-                if outbound["price"] is not None:
-                    price_usd = round(outbound["price"] * EXCHANGE_RATE["EUR_USD"], 2)
-                    web_link = f"https://www.flylevel.com/Flight/Select?culture=es-ES&triptype=OW&o1=EZE&d1={dest_code}&dd1={outbound['date']}&ADT=1&CHD=0&INL=0&r=false&mm=false&forcedCurrency=USD&forcedCulture=es-ES&newecom=true&currency=USD"
-                    message = f"✈️ <b>Level</b> | {dest_code}\n📅 Ida: <b>{outbound['date']}</b>\n💸 Precio solo ida: <b>${price_usd} USD</b>\n<a href=\"{web_link}\">Link</a>"
-                    results.append({
-                        "date": outbound["date"],
-                        "price": price_usd,
-                        "destination": dest_code,
-                        "webLink": web_link,
-                        "totalPrice": price_usd,
-                        "airline": "Level",
-                        "flight_type": "ONE_WAY",
-                        "message": message
-                    })
-
-                # Round-trip (14 days)
-                for inbound in unique_days[i+1:]:
-                    inbound_date = datetime.strptime(inbound["date"], "%Y-%m-%d")
-                    if (inbound_date - outbound_date).days != 14 or inbound_date > end_dt:
-                        continue
-                    if inbound["price"] is None:
-                        continue
+                yield Flight(AIRLINE, dest_code, outbound_day, price_out_usd, price_out_usd)
 
-                    price_out_usd = round(outbound["price"] * EXCHANGE_RATE["EUR_USD"], 2)
-                    price_in_usd = round(inbound["price"] * EXCHANGE_RATE["EUR_USD"], 2)
-                    total_price = price_out_usd + price_in_usd
-                    web_link = f"https://www.flylevel.com/Flight/Select?culture=es-ES&triptype=RT&o1=EZE&d1={dest_code}&dd1={outbound['date']}&ADT=1&CHD=0&INL=0&r=true&mm=false&dd2={inbound['date']}&forcedCurrency=USD&forcedCulture=es-ES&newecom=true&currency=USD"
-                    message = f"✈️ <b>Level</b> | {dest_code}\n📅 Ida: <b>{outbound['date']}</b> | Vuelta: <b>{inbound['date']}</b>\n⏳ Duración: <b>14 días</b>\n💸 Ida: <b>${price_out_usd} USD</b> | Vuelta: <b>${price_in_usd} USD</b>\n💰 Total: <b>${total_price} USD</b>\n<a href=\"{web_link}\">Link</a>"
-                    results.append({
-                        "date": outbound["date"],
-                        "price": price_out_usd,
-                        "return_date": inbound["date"],
-                        "return_price": price_in_usd,
-                        "destination": dest_code,
-                        "webLink": web_link,
-                        "totalPrice": total_price,
-                        "airline": "Level",
-                        "flight_type": "ROUND_TRIP",
-                        "message": message
-                    })
-        return results
+                # Round-trip (stay between min_stay and max_stay days)
+                for inbound_day, stay in day_index.returns_for(outbound_day, min_stay, max_stay, last_date=end_date):
+                    price_in_usd = prices_usd[inbound_day]
+                    yield Flight(AIRLINE, dest_code, outbound_day, price_out_usd, price_out_usd + price_in_usd,
+                                 flight_type=ROUND_TRIP, return_date=inbound_day, return_price=price_in_usd, stay=stay)
@@ -0,0 +1,63 @@
+"""
+Import-time report for app.py and stats.py (--profile-startup).
+The module is imported in a fresh interpreter run with `-X importtime`, so the
+numbers are those of a cold start and nothing from the current process leaks in.
+"""
+import os
+import sys
+import logging
+import subprocess
+from config import STARTUP_BUDGET
+
+try:
+    import resource
+except ImportError:  # Windows: the report goes without peak RSS
+    resource = None
+
+TOP_MODULES = 15
+
+def parse_importtime(stderr):
+    """[(module, self_us, cumulative_us, depth)] from the `-X importtime` output."""
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        entries.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return entries
+
+def profile_imports(module):
+    """Import `module` in a fresh interpreter. Returns (entries, total import seconds, peak RSS in MB or None)."""
+    before = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss if resource else 0
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True,
+        text=True
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{proc.stderr[-2000:]}")
+    entries = parse_importtime(proc.stderr)
+    total = sum(self_us for _, self_us, _, _ in entries) / 1e6
+    if resource is None:
+        return entries, total, None
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # ru_maxrss is in KB on Linux and bytes on macOS; only meaningful for the first child
+    peak_mb = max(peak, before) / (1024 * 1024 if sys.platform == "darwin" else 1024)
+    return entries, total, peak_mb
+
+def report(module):
+    """Log the slowest imports of `module` and whether it fits its STARTUP_BUDGET. Exits 1 if over budget."""
+    entries, total, peak_mb = profile_imports(module)
+    logging.info("--- Startup profile: import %s ---", module)
+    logging.info("Total import time: %.3f s | Peak RSS: %s | %d modules", total,
+                 f"{peak_mb:.1f} MB" if peak_mb is not None else "n/a", len(entries))
+    # Modules imported directly by the profiled one (or by the interpreter start-up)
+    direct = sorted((e for e in entries if e[3] == 1), key=lambda e: e[2], reverse=True)
+    for name, _, cumulative_us, _ in direct[:TOP_MODULES]:
+        logging.info("  %8.1f ms  %s", cumulative_us / 1000, name)
+    budget = STARTUP_BUDGET.get(module)
+    if budget is not None and total > budget:
+        logging.warning("Startup of %s takes %.3f s, over its %.3f s budget", module, total, budget)
+        sys.exit(1)
@@ -1,18 +1,19 @@
-import pandas as pd
+# pandas, matplotlib, seaborn and reportlab are imported by the functions that
+# use them, so data-only runs and importers of this module do not pay for them
 import logging
-from datetime import datetime, timedelta
-import matplotlib.pyplot as plt
-import seaborn as sns
-from reportlab.lib.pagesizes import letter
-from reportlab.lib.units import inch
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Image, Table, TableStyle
-from reportlab.lib.styles import getSampleStyleSheet
-from reportlab.lib import colors
+from datetime import datetime, timedelta, timezone
 import os
-import requests
-import time
+import sys
+import glob
 import json
-from get_aerolineas_token import get_token_with_selenium_wire
+import hashlib
+import argparse
+import sqlite3
+import requests
+import http_client
+import db
+from pairing import pair_round_trips, DEFAULT_STAY_RANGE
+from search_providers.aerolineas import TokenSession, TokenExpiredError, get_calendar_offers, offers_url, plan_offers_queries, observe_flex_window
 from telegram_utils import send_telegram_pdf
 
 # --- Configuration ---
@@ -30,24 +31,34 @@ DESTINATIONS = [
 ]
 START_DATE = datetime.now()
 END_DATE = START_DATE + timedelta(days=180)
+STAY_RANGE = DEFAULT_STAY_RANGE
+REPORT_DAYS = 7
+HISTORY_CHUNKSIZE = 10000
+HISTORY_QUERY = """
+    SELECT date, return_date, totalPrice, destination, airline, flight_type, last_seen
+    FROM flights
+    WHERE last_seen >= ? AND flight_type IN ({placeholders})
+"""
+HISTORY_DTYPES = {"totalPrice": "float64"}
+# Charts are rendered in parallel worker processes and cached under IMG_DIR by data fingerprint
+PLOT_WORKERS = min(4, len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1)
+PLOT_COLUMNS = ["date", "destination", "airline", "totalPrice"]
+PLOT_VERSION = 1  # bump when a chart's look changes, so cached images are redrawn
 
 # --- Robust Request Function with Retries ---
-def requests_get_with_retries(url, headers, timeout=10, retries=3, backoff_factor=0.5):
-    for i in range(retries):
-        try:
-            res = requests.get(url, headers=headers, timeout=timeout)
-            if 400 <= res.status_code < 500:
-                logging.error(f"Client error {res.status_code} for {url}. No more retries.")
-                return None
-            res.raise_for_status()
-            return res
-        except requests.exceptions.RequestException as e:
-            logging.warning(f"Request to {url} failed (attempt {i+1}/{retries}): {e}")
-            if i < retries - 1:
-                time.sleep(backoff_factor * (2 ** i))
-            else:
-                logging.error(f"Could not connect to {url} after {retries} attempts.")
-                return None
+def requests_get_with_retries(url, headers, timeout=10, retries=3, cache=True):
+    """GET through the shared HTTP client; returns None on client errors or once retries are exhausted."""
+    try:
+        res = http_client.get(url, headers=headers, timeout=timeout, retries=retries - 1, cache=cache)
+    except requests.RequestException:
+        return None
+    if 400 <= res.status_code < 500:
+        logging.error(f"Client error {res.status_code} for {url}. No more retries.")
+        return None
+    if res.status_code >= 500:
+        logging.error(f"Server error {res.status_code} for {url} after {retries} attempts.")
+        return None
+    return res
 
 # --- Data Fetching ---
 
@@ -71,89 +82,158 @@ def get_level_flights():
                     logging.error(f"Error decoding JSON from {api_url}: {e}")
             d = (d.replace(day=28) + timedelta(days=4)).replace(day=1)
 
-        unique_days = sorted(day_price_map.values(), key=lambda x: x["date"])
-        for i, outbound in enumerate(unique_days):
-            for inbound in unique_days[i+1:]:
-                outbound_date = datetime.strptime(outbound["date"], "%Y-%m-%d")
-                inbound_date = datetime.strptime(inbound["date"], "%Y-%m-%d")
-                if (inbound_date - outbound_date).days == 14:
-                    price_out_usd = round(outbound["price"] * EXCHANGE_RATE["EUR_USD"], 2)
-                    price_in_usd = round(inbound["price"] * EXCHANGE_RATE["EUR_USD"], 2)
-                    total_price = price_out_usd + price_in_usd
-                    all_flights.append({
-                        "date": outbound["date"],
-                        "totalPrice": total_price,
-                        "destination": dest["code"],
-                        "airline": "Level"
-                    })
+        for outbound_day, inbound_day, _ in pair_round_trips(day_price_map, day_price_map, *STAY_RANGE):
+            outbound, inbound = day_price_map[outbound_day], day_price_map[inbound_day]
+            price_out_usd = round(outbound["price"] * EXCHANGE_RATE["EUR_USD"], 2)
+            price_in_usd = round(inbound["price"] * EXCHANGE_RATE["EUR_USD"], 2)
+            total_price = price_out_usd + price_in_usd
+            all_flights.append({
+                "date": outbound["date"],
+                "totalPrice": total_price,
+                "destination": dest["code"],
+                "airline": "Level"
+            })
     return all_flights
 
 def get_aerolineas_flights():
     """Fetches all available flights from Aerolineas Argentinas."""
     logging.info("Fetching flights from Aerolíneas Argentinas...")
-    token = get_token_with_selenium_wire()
-    if not token:
+    session = TokenSession()
+    if not session.token:
         logging.error("Could not get token for Aerolíneas Argentinas.")
         return []
 
     all_flights = []
-    for dest in DESTINATIONS:
-        d = START_DATE.replace(day=1)
-        while d <= END_DATE:
-            leg1 = f"BUE-{dest['code']}-{d.strftime('%Y%m%d')}"
-            leg2 = f"{dest['code']}-BUE-{d.strftime('%Y%m%d')}"
-            url = f"https://api.aerolineas.com.ar/v1/flights/offers?adt=1&inf=0&chd=0&flexDates=true&cabinClass=Economy&flightType=ROUND_TRIP&leg={leg1}&leg={leg2}"
-            headers = {"Authorization": f"Bearer {token}", "User-Agent": "Mozilla/5.0", "Accept": "application/json"}
-            res = requests_get_with_retries(url, headers=headers)
-            if res:
-                try:
-                    offers = res.json().get("calendarOffers", {})
-                    ida_map, vuelta_map = {}, {}
-                    for offer in offers.get("0", []):
-                        if offer and isinstance(offer, dict) and not offer.get("soldOut") and isinstance(offer.get("offerDetails"), dict) and offer["offerDetails"].get("fare"):
-                            price_usd = int(offer["offerDetails"]["fare"].get("total") / EXCHANGE_RATE["ARS_USD"])
-                            ida_map[offer.get("departure")] = {"price": price_usd}
-                    for offer in offers.get("1", []):
-                        if offer and isinstance(offer, dict) and not offer.get("soldOut") and isinstance(offer.get("offerDetails"), dict) and offer["offerDetails"].get("fare"):
-                            price_usd = int(offer["offerDetails"]["fare"].get("total") / EXCHANGE_RATE["ARS_USD"])
-                            vuelta_map[offer.get("departure")] = {"price": price_usd}
-
-                    for ida_date, ida_info in ida_map.items():
-                        d1 = datetime.strptime(ida_date, "%Y-%m-%d")
-                        vuelta_date = (d1 + timedelta(days=14)).strftime("%Y-%m-%d")
-                        if vuelta_date in vuelta_map:
-                            total_price = ida_info["price"] + vuelta_map[vuelta_date]["price"]
-                            all_flights.append({
-                                "date": ida_date,
-                                "totalPrice": total_price,
-                                "destination": dest["code"],
-                                "airline": "Aerolíneas Argentinas"
-                            })
-                except json.JSONDecodeError as e:
-                    logging.error(f"Error decoding JSON from {url}: {e}")
-            d = (d.replace(day=28) + timedelta(days=4)).replace(day=1)
+    try:
+        _collect_aerolineas_flights(session, all_flights)
+    except TokenExpiredError as e:
+        logging.error(f"Aerolíneas token rejected even after refreshing it ({e}). Keeping {len(all_flights)} flights.")
     return all_flights
 
+def _collect_aerolineas_flights(session, all_flights):
+    start_date, end_date = START_DATE.strftime("%Y-%m-%d"), END_DATE.strftime("%Y-%m-%d")
+    queries = plan_offers_queries([dest["code"] for dest in DESTINATIONS], start_date, end_date, STAY_RANGE)
+    logging.info(f"Planned {len(queries)} Aerolíneas flexDates queries.")
+    for dest_code, anchor, vuelta_anchor in queries:
+        url = offers_url(dest_code, anchor, vuelta_anchor)
+        offers = session.call(get_calendar_offers, url) or {}
+        observe_flex_window(anchor, offers.get("0", []))
+        if offers:
+            try:
+                ida_map, vuelta_map = {}, {}
+                for offer in offers.get("0", []):
+                    if offer and isinstance(offer, dict) and not offer.get("soldOut") and isinstance(offer.get("offerDetails"), dict) and offer["offerDetails"].get("fare"):
+                        if not start_date <= offer.get("departure", "") <= end_date:
+                            continue
+                        price_usd = int(offer["offerDetails"]["fare"].get("total") / EXCHANGE_RATE["ARS_USD"])
+                        ida_map[offer.get("departure")] = {"price": price_usd}
+                for offer in offers.get("1", []):
+                    if offer and isinstance(offer, dict) and not offer.get("soldOut") and isinstance(offer.get("offerDetails"), dict) and offer["offerDetails"].get("fare"):
+                        price_usd = int(offer["offerDetails"]["fare"].get("total") / EXCHANGE_RATE["ARS_USD"])
+                        vuelta_map[offer.get("departure")] = {"price": price_usd}
+
+                for ida_date, vuelta_date, _ in pair_round_trips(ida_map, vuelta_map, *STAY_RANGE):
+                    total_price = ida_map[ida_date]["price"] + vuelta_map[vuelta_date]["price"]
+                    all_flights.append({
+                        "date": ida_date,
+                        "totalPrice": total_price,
+                        "destination": dest_code,
+                        "airline": "Aerolíneas Argentinas"
+                    })
+            except (TypeError, ValueError) as e:
+                logging.error(f"Error parsing offers from {url}: {e}")
+
+def load_history(days=REPORT_DAYS, flight_types=("ROUND_TRIP",)):
+    """
+    Builds the report DataFrame from the flights the bot stored during the last
+    `days` days, reading the table in typed chunks instead of re-scraping.
+    """
+    import pandas as pd
+    if not os.path.exists(db.DB_FILE):
+        logging.warning(f"Database {db.DB_FILE} not found.")
+        return pd.DataFrame()
+    since = (datetime.now(timezone.utc) - timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
+    query = HISTORY_QUERY.format(placeholders=", ".join("?" * len(flight_types)))
+    with db.get_conn() as conn:
+        try:
+            chunks = list(pd.read_sql_query(
+                query, conn,
+                params=(since, *flight_types),
+                parse_dates=["date", "last_seen"],
+                dtype=HISTORY_DTYPES,
+                chunksize=HISTORY_CHUNKSIZE
+            ))
+        except (sqlite3.Error, pd.errors.DatabaseError) as e:
+            logging.error(f"Could not read flight history: {e}")
+            return pd.DataFrame()
+    if not chunks:
+        return pd.DataFrame()
+    df = pd.concat(chunks, ignore_index=True)
+    logging.info(f"Loaded {len(df)} flights seen since {since} UTC from {db.DB_FILE}.")
+    return df
+
 # --- Data Analysis & Visualization ---
 
-def generate_visualizations(df):
-    """Generates and saves all visualizations."""
+def data_fingerprint(df):
+    """Short hash of the rows and columns the charts are drawn from."""
+    import pandas as pd
+    digest = hashlib.sha1(f"{PLOT_VERSION}/{[d['code'] for d in DESTINATIONS]}/{list(df.columns)}".encode())
+    digest.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    return digest.hexdigest()[:16]
+
+def _render_plot(name, df, path):
+    """Draws one chart on the non-interactive Agg backend; runs in a worker process."""
+    import matplotlib
+    matplotlib.use("Agg")
+    return PLOTS[name](df, path)
+
+def _prune_images(name, keep):
+    for old in glob.glob(os.path.join(IMG_DIR, f"{name}-*.png")):
+        if old != keep:
+            os.remove(old)
+
+def generate_visualizations(df, workers=PLOT_WORKERS):
+    """
+    Generates and saves all visualizations. Each chart is cached as
+    IMG_DIR/<name>-<fingerprint>.png and only redrawn when the data changed;
+    missing charts are drawn in parallel in up to `workers` processes.
+    """
     if df.empty:
         return {}
     os.makedirs(IMG_DIR, exist_ok=True)
-    
-    visualizations = {
-        "price_trends": plot_price_trends(df),
-        "top_destinations": plot_top_destinations(df),
-        "price_distribution": plot_price_distribution(df),
-        "price_vs_destination": plot_price_vs_destination(df),
-    }
-    return {k: v for k, v in visualizations.items() if v}
+    # Workers get their own read-only copy of just the columns they plot
+    df = df[[column for column in PLOT_COLUMNS if column in df.columns]].reset_index(drop=True)
+    fingerprint = data_fingerprint(df)
+    paths = {name: os.path.join(IMG_DIR, f"{name}-{fingerprint}.png") for name in PLOTS}
+    missing = [name for name, path in paths.items() if not os.path.exists(path)]
+    logging.info(f"Charts for data {fingerprint}: {len(paths) - len(missing)} cached, {len(missing)} to render.")
+
+    if len(missing) > 1 and workers > 1:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        from concurrent.futures.process import BrokenProcessPool
+        try:
+            # spawn: forking a parent that already loaded matplotlib or holds threads is not safe
+            with ProcessPoolExecutor(min(workers, len(missing)), mp_context=multiprocessing.get_context("spawn")) as pool:
+                futures = {name: pool.submit(_render_plot, name, df, paths[name]) for name in missing}
+                for name, future in futures.items():
+                    future.result()
+            missing = []
+        except (BrokenProcessPool, OSError) as e:
+            logging.warning(f"Chart worker pool failed ({e}); rendering sequentially.")
+            missing = [name for name in missing if not os.path.exists(paths[name])]
+    for name in missing:
+        _render_plot(name, df, paths[name])
+
+    for name, path in paths.items():
+        _prune_images(name, path)
+    return {name: path for name, path in paths.items() if os.path.exists(path)}
 
 # --- Nuevo gráfico: Precio vs Destino por Aerolínea ---
-def plot_price_vs_destination(df):
+def plot_price_vs_destination(df, path):
     """Boxplot de precios por destino y aerolínea, asegurando todos los destinos."""
-    path = os.path.join(IMG_DIR, "price_vs_destination.png")
+    import matplotlib.pyplot as plt
+    import seaborn as sns
     plt.figure(figsize=(18, 8))
     plt.rcParams.update({'font.size': 16, 'font.family': 'DejaVu Sans'})
     destinos_order = [d['code'] for d in DESTINATIONS]
@@ -180,9 +260,9 @@ def plot_price_vs_destination(df):
     return path
 
 # --- Asegurar todos los destinos en top_destinations ---
-def plot_top_destinations(df):
+def plot_top_destinations(df, path):
     """Plots and saves a grouped bar chart of top destinations by airline, asegurando todos los destinos."""
-    path = os.path.join(IMG_DIR, "top_destinations.png")
+    import matplotlib.pyplot as plt
     plt.figure(figsize=(16, 8))
     plt.rcParams.update({'font.size': 16, 'font.family': 'DejaVu Sans'})
     destinos_order = [d['code'] for d in DESTINATIONS]
@@ -204,13 +284,14 @@ def plot_top_destinations(df):
     plt.close()
     return path
 
-def plot_price_trends(df):
+def plot_price_trends(df, path):
     """Plots and saves a line chart of average price per day, differentiated by airline."""
-    path = os.path.join(IMG_DIR, "price_trends.png")
+    import pandas as pd
+    import matplotlib.pyplot as plt
     plt.figure(figsize=(16, 8))
     plt.rcParams.update({'font.size': 16, 'font.family': 'DejaVu Sans'})
-    df['date'] = pd.to_datetime(df['date'])
-    avg_price_per_day = df.groupby([df['date'].dt.date, 'airline'])['totalPrice'].mean().unstack()
+    dates = pd.to_datetime(df['date'])
+    avg_price_per_day = df.groupby([dates.dt.date, 'airline'])['totalPrice'].mean().unstack()
     avg_price_per_day.plot(kind='line', marker='o', ax=plt.gca())
     plt.title("Average Price Trend by Airline (Last 7 Days)", fontsize=22)
     plt.xlabel("Date", fontsize=18)
@@ -222,9 +303,10 @@ def plot_price_trends(df):
     plt.close()
     return path
 
-def plot_price_distribution(df):
+def plot_price_distribution(df, path):
     """Plots and saves overlapping density plots of flight prices by airline."""
-    path = os.path.join(IMG_DIR, "price_distribution.png")
+    import matplotlib.pyplot as plt
+    import seaborn as sns
     plt.figure(figsize=(16, 8))
     plt.rcParams.update({'font.size': 16, 'font.family': 'DejaVu Sans'})
     sns.kdeplot(data=df, x='totalPrice', hue='airline', fill=True, common_norm=False)
@@ -237,10 +319,22 @@ def plot_price_distribution(df):
     plt.close()
     return path
 
+PLOTS = {
+    "price_trends": plot_price_trends,
+    "top_destinations": plot_top_destinations,
+    "price_distribution": plot_price_distribution,
+    "price_vs_destination": plot_price_vs_destination,
+}
+
 # --- PDF Generation ---
 
 def create_pdf_report(df, visualizations):
     """Creates a PDF report with statistics and visualizations."""
+    from reportlab.lib.pagesizes import letter
+    from reportlab.lib.units import inch
+    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Image, Table, TableStyle
+    from reportlab.lib.styles import getSampleStyleSheet
+    from reportlab.lib import colors
     doc = SimpleDocTemplate(PDF_PATH, pagesize=letter)
     styles = getSampleStyleSheet()
     story = []
@@ -254,13 +348,7 @@ def create_pdf_report(df, visualizations):
     story.append(Spacer(1, 0.25 * inch))
 
     if not df.empty:
-        key_metrics = {
-            "Average Price": f"${df['totalPrice'].mean():.2f}",
-            "Median Price": f"${df['totalPrice'].median():.2f}",
-            "Minimum Price": f"${df['totalPrice'].min():.2f}",
-            "Maximum Price": f"${df['totalPrice'].max():.2f}",
-        }
-        table_data = [["Metric", "Value"]] + list(key_metrics.items())
+        table_data = [["Metric", "Value"]] + list(key_metrics(df).items())
         table = Table(table_data)
         table.setStyle(TableStyle([
             ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
@@ -286,6 +374,14 @@ def create_pdf_report(df, visualizations):
     doc.build(story)
     logging.info(f"PDF report created successfully: {PDF_PATH}")
 
+def key_metrics(df):
+    return {
+        "Average Price": f"${df['totalPrice'].mean():.2f}",
+        "Median Price": f"${df['totalPrice'].median():.2f}",
+        "Minimum Price": f"${df['totalPrice'].min():.2f}",
+        "Maximum Price": f"${df['totalPrice'].max():.2f}",
+    }
+
 def get_conclusion(title, df):
     if title == "price_trends":
         return "The line chart displays the daily average flight prices for each airline. This helps identify which airline consistently offers lower prices and reveals how their pricing strategies compare over time."
@@ -299,24 +395,48 @@ def get_conclusion(title, df):
 
 # --- Main Execution ---
 
-def main():
-    """Main function to generate and send the weekly report."""
+def main(source="db", days=REPORT_DAYS, report=True, record=None, replay=None):
+    """
+    Main function to generate and send the weekly report. With report=False only the key metrics are logged.
+    record/replay: directory to archive the provider traffic to / replay it from.
+    """
+    global START_DATE, END_DATE
     logging.basicConfig(level=logging.INFO)
+    if record:
+        http_client.start_recording(record, sys.argv)
+    elif replay:
+        replayer = http_client.start_replay(replay)
+        # Scrape the same dates as the recorded run
+        if replayer.started_at:
+            START_DATE = datetime.fromtimestamp(replayer.started_at)
+            END_DATE = START_DATE + timedelta(days=180)
+    try:
+        _report(source, days, report)
+    finally:
+        http_client.stop_archive()
+
+def _report(source, days, report):
     # if datetime.now().weekday() != 6: # 0=lunes, 6=domingo
     #     logging.info("Today is not Sunday. Skipping weekly report.")
     #     return
 
     logging.info("Initiating the generation of the weekly report...")
-    
-    level_flights = get_level_flights()
-    aerolineas_flights = get_aerolineas_flights()
-    
-    all_flights = level_flights + aerolineas_flights
-    if not all_flights:
+
+    if source == "db":
+        df = load_history(days)
+    else:
+        level_flights = get_level_flights()
+        aerolineas_flights = get_aerolineas_flights()
+        import pandas as pd
+        df = pd.DataFrame(level_flights + aerolineas_flights)
+    if df.empty:
         logging.warning("No data available for the weekly report. Skipping.")
         return
+    if not report:
+        for metric, value in key_metrics(df).items():
+            logging.info(f"{metric}: {value} ({len(df)} flights)")
+        return
 
-    df = pd.DataFrame(all_flights)
     visualizations = generate_visualizations(df)
     create_pdf_report(df, visualizations)
     
@@ -324,4 +444,22 @@ def main():
     send_telegram_pdf(PDF_PATH, caption=caption)
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Generates the weekly flight report PDF.")
+    parser.add_argument("--source", choices=["db", "scrape"], default="db",
+                        help="db: flights stored by app.py (default); scrape: query every provider again")
+    parser.add_argument("--days", type=int, default=REPORT_DAYS, help="History window for --source db")
+    parser.add_argument("--no-report", action="store_true",
+                        help="only log the key metrics; skips the charts, the PDF and Telegram")
+    parser.add_argument("--profile-startup", action="store_true",
+                        help="report the import time of this script and exit")
+    archive = parser.add_mutually_exclusive_group()
+    archive.add_argument("--record", metavar="DIR", help="archive every provider response of this run in DIR")
+    archive.add_argument("--replay", metavar="DIR",
+                         help="re-run offline from the responses archived in DIR (no network, no Chrome)")
+    args = parser.parse_args()
+    if args.profile_startup:
+        logging.basicConfig(level=logging.INFO)
+        import startup_profile
+        startup_profile.report("stats")
+    else:
+        main(source=args.source, days=args.days, report=not args.no_report, record=args.record, replay=args.replay)
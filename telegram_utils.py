@@ -1,30 +1,186 @@
 import os
+import time
+import queue
 import requests
 import logging
+import threading
+import http_client
+import tracing
+from flights import Flight
 from dotenv import load_dotenv
 load_dotenv()
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 TELEGRAM_CHAT_ID = os.getenv("TELEGRAM_CHAT_ID")
 
+MAX_MESSAGE_LENGTH = 4096  # límite de Telegram para sendMessage
+MESSAGE_SEPARATOR = "\n\n"
+MESSAGES_PER_SECOND = 1  # ritmo sostenido por chat
+BURST_SIZE = 3
+MAX_SEND_ATTEMPTS = 5
+BATCH_LINGER = 0.5  # segundos que se espera para juntar más ofertas en un mensaje
+
+class TokenBucket:
+    """Limita el ritmo de envío: `rate` mensajes por segundo con ráfagas de hasta `capacity`."""
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            wait = (1 - self.tokens) / self.rate if self.tokens < 1 else 0
+            self.tokens -= 1
+        if wait:
+            time.sleep(wait)
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+def _bucket_for(chat_id):
+    with _buckets_lock:
+        if chat_id not in _buckets:
+            _buckets[chat_id] = TokenBucket(MESSAGES_PER_SECOND, BURST_SIZE)
+        return _buckets[chat_id]
+
+def _post_message(chat_id, message, parse_mode):
+    """Envía un mensaje respetando el ritmo del chat y los retry_after de los 429. Devuelve True si se entregó."""
+    start = time.perf_counter()
+    delivered = _deliver(chat_id, message, parse_mode)
+    tracing.observe("telegram_send", time.perf_counter() - start, outcome="delivered" if delivered else "failed")
+    return delivered
+
+def _deliver(chat_id, message, parse_mode):
+    url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
+    data = {
+        "chat_id": chat_id,
+        "text": message,
+        "parse_mode": parse_mode
+    }
+    bucket = _bucket_for(chat_id)
+    for attempt in range(1, MAX_SEND_ATTEMPTS + 1):
+        bucket.acquire()
+        try:
+            resp = http_client.post(url, data=data, timeout=10, retries=0)
+            if resp.status_code == 429:
+                try:
+                    retry_after = resp.json().get("parameters", {}).get("retry_after", 1)
+                except ValueError:
+                    retry_after = int(resp.headers.get("Retry-After", 1))
+                logging.warning("Telegram pidió esperar %ss (intento %d/%d)", retry_after, attempt, MAX_SEND_ATTEMPTS)
+                time.sleep(retry_after)
+                continue
+            if 400 <= resp.status_code < 500:
+                # Mensaje mal formado, bot bloqueado...: reintentar no cambia nada
+                try:
+                    description = resp.json().get("description")
+                except ValueError:
+                    description = resp.text[:200]
+                logging.error("Telegram rechazó el mensaje (%d): %s", resp.status_code, description)
+                return False
+            resp.raise_for_status()
+            return True
+        except requests.RequestException as e:
+            logging.error("Error enviando mensaje a Telegram (intento %d/%d): %s", attempt, MAX_SEND_ATTEMPTS, e)
+            if attempt < MAX_SEND_ATTEMPTS:
+                time.sleep(2 ** attempt)
+    return False
+
+def pack_messages(items, limit=MAX_MESSAGE_LENGTH):
+    """
+    Agrupa (mensaje, payload) en la menor cantidad de textos de hasta `limit` caracteres.
+    Devuelve una lista de (texto, payloads).
+    """
+    packed = []
+    text, payloads = "", []
+    for message, payload in items:
+        message = message[:limit]
+        candidate = f"{text}{MESSAGE_SEPARATOR}{message}" if text else message
+        if text and len(candidate) > limit:
+            packed.append((text, payloads))
+            text, payloads = message, [payload]
+        else:
+            text = candidate
+            payloads.append(payload)
+    if text:
+        packed.append((text, payloads))
+    return packed
+
 def send_telegram(message: str, parse_mode: str = "HTML"):
     """
     Envía un mensaje de texto al chat de Telegram configurado.
     Permite especificar el parse_mode (por defecto HTML).
+    Devuelve True si Telegram aceptó el mensaje.
     """
     if not TELEGRAM_TOKEN or not TELEGRAM_CHAT_ID:
         logging.warning("TELEGRAM_TOKEN y TELEGRAM_CHAT_ID deben estar configurados en variables de entorno.")
-        return
-    url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
-    data = {
-        "chat_id": TELEGRAM_CHAT_ID,
-        "text": message,
-        "parse_mode": parse_mode
-    }
-    try:
-        resp = requests.post(url, data=data, timeout=10)
-        resp.raise_for_status()
-    except requests.RequestException as e:
-        logging.error("Error enviando mensaje a Telegram: %s", e)
+        return False
+    return _post_message(TELEGRAM_CHAT_ID, message, parse_mode)
+
+class TelegramDispatcher:
+    """
+    Cola de envío en segundo plano: junta las ofertas en mensajes de hasta 4096
+    caracteres y los envía sin bloquear la búsqueda. `on_delivered(payloads)` se
+    llama con los payloads de cada mensaje entregado.
+    """
+    _STOP = object()
+
+    def __init__(self, on_delivered=None, parse_mode="HTML", chat_id=None):
+        self.on_delivered = on_delivered
+        self.parse_mode = parse_mode
+        self.chat_id = chat_id or TELEGRAM_CHAT_ID
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="telegram-dispatcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, message, payload=None):
+        """
+        `message` es un texto o un flights.Flight; el HTML de un Flight se genera
+        recién en el hilo de envío y el Flight se usa como payload.
+        """
+        if isinstance(message, Flight):
+            payload = message if payload is None else payload
+        self._queue.put((message, payload))
+
+    def _drain(self, first):
+        """Junta lo que llegue durante BATCH_LINGER segundos. Devuelve (items, stop)."""
+        items = [first]
+        deadline = time.monotonic() + BATCH_LINGER
+        while True:
+            try:
+                item = self._queue.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                return items, False
+            if item is self._STOP:
+                return items, True
+            items.append(item)
+
+    def _run(self):
+        stop = False
+        while not stop:
+            first = self._queue.get()
+            if first is self._STOP:
+                return
+            items, stop = self._drain(first)
+            if not TELEGRAM_TOKEN or not self.chat_id:
+                logging.warning("TELEGRAM_TOKEN y TELEGRAM_CHAT_ID deben estar configurados en variables de entorno.")
+                continue
+            items = [(m.message if isinstance(m, Flight) else m, p) for m, p in items]
+            for text, payloads in pack_messages(items):
+                if _post_message(self.chat_id, text, self.parse_mode) and self.on_delivered:
+                    try:
+                        self.on_delivered([p for p in payloads if p is not None])
+                    except Exception:
+                        logging.exception("Error registrando mensajes entregados")
+
+    def close(self):
+        """Envía lo pendiente y detiene el hilo."""
+        self._queue.put(self._STOP)
+        self._thread.join()
 
 def send_telegram_pdf(file_path: str, caption: str = ""):
     """
@@ -38,7 +194,7 @@ def send_telegram_pdf(file_path: str, caption: str = ""):
     files = {'document': open(file_path, 'rb')}
     data = {'chat_id': TELEGRAM_CHAT_ID, 'caption': caption}
     try:
-        resp = requests.post(url, data=data, files=files, timeout=20)
+        resp = http_client.post(url, data=data, files=files, timeout=20, retries=0)
         resp.raise_for_status()
         logging.info(f"PDF enviado a Telegram con caption: {caption}")
     except requests.RequestException as e:
@@ -53,7 +209,7 @@ def get_chat_id():
         return
     url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/getUpdates"
     try:
-        resp = requests.get(url, timeout=10)
+        resp = http_client.get(url, timeout=10)
         resp.raise_for_status()
         data = resp.json()
         for result in data.get("result", []):
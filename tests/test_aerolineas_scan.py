@@ -0,0 +1,57 @@
+import pytest
+import db
+import response_cache
+from search_providers import aerolineas
+from search_providers.aerolineas import AerolineasProvider
+
+DESTINATIONS = ["MAD"]
+START_DATE, END_DATE = "2030-03-01", "2030-04-30"
+
+class FakeSession:
+    """Answers every offers query with `offers` (None = failed request)."""
+    token = "token"
+
+    def __init__(self, offers):
+        self.offers = offers
+        self.calls = 0
+
+    def call(self, fn, url):
+        self.calls += 1
+        return self.offers
+
+@pytest.fixture
+def scan(tmp_path, monkeypatch):
+    """scan(session) runs an incremental scan with session; returns how many tokens were requested."""
+    monkeypatch.setattr(db, "DB_FILE", str(tmp_path / "flights.db"))
+    monkeypatch.setattr(response_cache, "CACHE_FILE", str(tmp_path / "cache.db"))
+    monkeypatch.setattr(response_cache, "_conn", None)
+    db.close_db()
+    db.init_db()
+
+    def run(session):
+        tokens = []
+        monkeypatch.setattr(aerolineas, "TokenSession", lambda: tokens.append(session) or session)
+        list(AerolineasProvider().iter_flights(None, DESTINATIONS, START_DATE, END_DATE, incremental=True))
+        return len(tokens)
+
+    yield run
+    db.close_db()
+
+def test_failed_fetch_keeps_unit_due(scan):
+    outage = FakeSession(None)
+    scan(outage)
+    assert outage.calls > 0
+    assert db.load_scan_units("aerolineas") == {}
+
+    # Back up: every unit is still due and gets scanned and recorded
+    recovered = FakeSession({})
+    scan(recovered)
+    assert recovered.calls == outage.calls
+    assert set(db.load_scan_units("aerolineas")) == {("MAD", "2030-03"), ("MAD", "2030-04")}
+
+def test_no_token_when_nothing_is_due(scan):
+    assert scan(FakeSession({})) == 1
+    # An empty calendar is a real scan: nothing is due right after it, so no token is needed
+    again = FakeSession({})
+    assert scan(again) == 0
+    assert again.calls == 0
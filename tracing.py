@@ -0,0 +1,125 @@
+"""
+In-process spans for the hot paths (token, HTTP, pairing, validation, DB,
+Telegram). Durations are aggregated per (span, labels) into fixed-bucket
+histograms, so memory stays constant however long the run; export() writes
+them per run as JSON and as a Prometheus textfile.
+"""
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+from config import METRICS_DIR, PROMETHEUS_TEXTFILE
+from file_utils import write_atomic
+
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)  # seconds, upper bounds
+PROMETHEUS_PREFIX = "flightbot"
+
+_histograms = {}
+_counters = {}
+_lock = threading.Lock()
+_started_at = time.time()
+
+def _key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def observe(name, seconds, **labels):
+    """Add one duration to the histogram of span `name` with these labels."""
+    key = _key(name, labels)
+    index = next((i for i, bound in enumerate(BUCKETS) if seconds <= bound), len(BUCKETS))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = {"count": 0, "sum": 0.0, "min": seconds, "max": seconds,
+                                            "buckets": [0] * (len(BUCKETS) + 1)}
+        histogram["count"] += 1
+        histogram["sum"] += seconds
+        histogram["min"] = min(histogram["min"], seconds)
+        histogram["max"] = max(histogram["max"], seconds)
+        histogram["buckets"][index] += 1
+
+def add(name, value=1, **labels):
+    """Increase counter `name` (e.g. bytes received) by value."""
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+@contextmanager
+def span(name, **labels):
+    """
+    Time the block as span `name`; also usable as a function decorator.
+    A block that raises is recorded with an `error` label.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException as e:
+        observe(name, time.perf_counter() - start, error=type(e).__name__, **labels)
+        raise
+    observe(name, time.perf_counter() - start, **labels)
+
+def snapshot():
+    """Everything recorded since the last reset(), as plain data."""
+    with _lock:
+        return {
+            "started_at": _started_at,
+            "finished_at": time.time(),
+            "spans": [
+                {"name": name, "labels": dict(labels), "count": h["count"], "sum": h["sum"], "min": h["min"],
+                 "max": h["max"], "buckets": dict(zip([str(b) for b in BUCKETS] + ["+Inf"], h["buckets"]))}
+                for (name, labels), h in sorted(_histograms.items())
+            ],
+            "counters": [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in sorted(_counters.items())
+            ],
+        }
+
+def reset():
+    global _started_at
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+        _started_at = time.time()
+
+def _labels_text(labels, extra=()):
+    pairs = list(labels.items()) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + "}"
+
+def prometheus_text(data):
+    """Prometheus text exposition of a snapshot(): one histogram for every span, one counter per counter name."""
+    lines = [
+        f"# HELP {PROMETHEUS_PREFIX}_span_seconds Duration of the bot's hot-path spans.",
+        f"# TYPE {PROMETHEUS_PREFIX}_span_seconds histogram",
+    ]
+    for span_data in data["spans"]:
+        labels = {"span": span_data["name"], **span_data["labels"]}
+        cumulative = 0
+        for le, count in span_data["buckets"].items():
+            cumulative += count
+            lines.append(f"{PROMETHEUS_PREFIX}_span_seconds_bucket{_labels_text(labels, [('le', le)])} {cumulative}")
+        lines.append(f"{PROMETHEUS_PREFIX}_span_seconds_sum{_labels_text(labels)} {span_data['sum']:.6f}")
+        lines.append(f"{PROMETHEUS_PREFIX}_span_seconds_count{_labels_text(labels)} {span_data['count']}")
+    declared = set()
+    for counter in data["counters"]:
+        metric = f"{PROMETHEUS_PREFIX}_{counter['name']}_total"
+        if metric not in declared:
+            declared.add(metric)
+            lines.append(f"# TYPE {metric} counter")
+        lines.append(f"{metric}{_labels_text(counter['labels'])} {counter['value']}")
+    lines.append(f"# TYPE {PROMETHEUS_PREFIX}_last_run_timestamp_seconds gauge")
+    lines.append(f"{PROMETHEUS_PREFIX}_last_run_timestamp_seconds {data['finished_at']:.0f}")
+    return "\n".join(lines) + "\n"
+
+def export(reset_after=True):
+    """Write this run's metrics to METRICS_DIR/run-<timestamp>.json and PROMETHEUS_TEXTFILE. Returns the JSON path."""
+    data = snapshot()
+    json_path = os.path.join(METRICS_DIR, time.strftime("run-%Y%m%d-%H%M%S.json", time.localtime(data["started_at"])))
+    write_atomic(json_path, json.dumps(data, indent=2))
+    write_atomic(PROMETHEUS_TEXTFILE, prometheus_text(data))
+    if reset_after:
+        reset()
+    return json_path
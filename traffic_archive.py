@@ -0,0 +1,118 @@
+"""
+Record/replay of the provider HTTP traffic (app.py/stats.py --record DIR / --replay DIR).
+Every response http_client receives is appended to DIR/traffic.jsonl.gz; on
+replay the same requests are answered from it, with no network and no Chrome,
+so a production run can be reproduced and profiled offline.
+"""
+import os
+import gzip
+import json
+import time
+import base64
+import logging
+import threading
+from collections import defaultdict, deque
+from urllib.parse import urlsplit
+import requests
+from response_cache import normalize_url
+
+ARCHIVE_NAME = "traffic.jsonl.gz"
+# Never archived (the bot token is part of the URL); answered with {"ok": true} on replay
+UNRECORDED_HOSTS = {"api.telegram.org"}
+KEPT_HEADERS = ("Content-Type", "Retry-After")
+
+def archive_path(directory):
+    return os.path.join(directory, ARCHIVE_NAME)
+
+def _response(url, status, body, headers=None):
+    res = requests.Response()
+    res.status_code = status
+    res._content = body
+    res.url = url
+    res.headers.update(headers or {})
+    res.headers["X-Replay"] = "1"
+    return res
+
+class Recorder:
+    """Appends each response to the archive as one JSON line."""
+    def __init__(self, directory, argv=None):
+        os.makedirs(directory, exist_ok=True)
+        self.path = archive_path(directory)
+        self.count = 0
+        self._lock = threading.Lock()
+        self._file = gzip.open(self.path, "wt", encoding="utf-8")
+        self._meta = {}
+        self._write({"meta": {"started_at": time.time(), "argv": argv}})
+        logging.info("Grabando el tráfico de los proveedores en %s", self.path)
+
+    def _write(self, entry):
+        self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def annotate(self, key, value):
+        """Store a run setting (e.g. a planning parameter) the replay has to reuse."""
+        with self._lock:
+            if self._meta.get(key) == value:
+                return
+            self._meta[key] = value
+            self._write({"meta": {key: value}})
+
+    def record(self, method, url, res):
+        if urlsplit(url).hostname in UNRECORDED_HOSTS:
+            return
+        entry = {
+            "method": method,
+            "url": normalize_url(url),
+            "status": res.status_code,
+            "headers": {name: res.headers[name] for name in KEPT_HEADERS if name in res.headers},
+        }
+        try:
+            entry["body"] = res.content.decode("utf-8")
+        except UnicodeDecodeError:
+            entry["body_b64"] = base64.b64encode(res.content).decode("ascii")
+        with self._lock:
+            self._write(entry)
+            self.count += 1
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+        logging.info("%d respuestas grabadas en %s", self.count, self.path)
+
+class Replayer:
+    """Answers requests from an archive. Repeated requests get the recorded responses in order."""
+    def __init__(self, directory):
+        self.path = archive_path(directory)
+        self.meta = {}
+        self.misses = 0
+        self._responses = defaultdict(deque)
+        self._lock = threading.Lock()
+        with gzip.open(self.path, "rt", encoding="utf-8") as f:
+            for line in f:
+                entry = json.loads(line)
+                if "meta" in entry:
+                    self.meta.update(entry["meta"])
+                    continue
+                body = entry["body"].encode("utf-8") if "body" in entry else base64.b64decode(entry["body_b64"])
+                self._responses[(entry["method"], entry["url"])].append((entry["status"], body, entry["headers"]))
+        logging.info("Reproduciendo %d respuestas grabadas en %s", sum(map(len, self._responses.values())), self.path)
+
+    @property
+    def started_at(self):
+        return self.meta.get("started_at")
+
+    def respond(self, method, url):
+        """The recorded response, or requests.ConnectionError if the request was never recorded."""
+        if urlsplit(url).hostname in UNRECORDED_HOSTS:
+            return _response(url, 200, b'{"ok": true, "result": {}}', {"Content-Type": "application/json"})
+        with self._lock:
+            queue = self._responses.get((method, normalize_url(url)))
+            if not queue:
+                self.misses += 1
+                raise requests.ConnectionError(f"{method} {url} is not in {self.path}")
+            # The last response keeps answering once the recorded ones are used up
+            status, body, headers = queue.popleft() if len(queue) > 1 else queue[0]
+        return _response(url, status, body, headers)
+
+    def close(self):
+        if self.misses:
+            logging.warning("%d requests were not in the recording", self.misses)